@@ -0,0 +1,76 @@
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+CONVERTED = "converted"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+
+# Outcomes that do not need to be retried on restart
+FINISHED_OUTCOMES = (CONVERTED, DUPLICATE)
+
+
+class ConversionCheckpoint(object):
+  """
+  Append-only journal of (user id, stage, doc id, outcome) written while converting docs. The stage is part of the
+  key as saved queries are converted by both the saved query and the history loop.
+  On restart the journal is loaded into memory so finished docs are skipped with a set lookup. Finished doc ids are
+  kept in one set per (user id, stage) so each entry costs an int in a set rather than a tuple with its own copy of
+  the stage name.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.finished = {}
+    self._handle = None
+    self._pid = None
+    self.load()
+
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return
+    with open(self.path) as journal:
+      for line in journal:
+        fields = line.rstrip("\n").split("\t")
+        # A partially written last line after a crash is ignored
+        if len(fields) != 4:
+          continue
+        user_id, stage, doc_id, outcome = fields
+        doc_ids = self._doc_ids(int(user_id), stage)
+        if outcome in FINISHED_OUTCOMES:
+          doc_ids.add(int(doc_id))
+        else:
+          doc_ids.discard(int(doc_id))
+    LOG.info("Loaded %s finished docs from checkpoint: %s" % (sum(len(doc_ids) for doc_ids in self.finished.values()), self.path))
+
+
+  def _doc_ids(self, user_id, stage):
+    key = (user_id, intern(stage))
+    doc_ids = self.finished.get(key)
+    if doc_ids is None:
+      doc_ids = self.finished[key] = set()
+    return doc_ids
+
+
+  def is_done(self, user_id, stage, doc_id):
+    doc_ids = self.finished.get((user_id, stage))
+    return doc_ids is not None and doc_id in doc_ids
+
+
+  def record(self, user_id, stage, doc_id, outcome):
+    # Worker processes reopen the journal so each has its own O_APPEND handle
+    if self._handle is None or self._pid != os.getpid():
+      self._handle = open(self.path, "a")
+      self._pid = os.getpid()
+    self._handle.write("%s\t%s\t%s\t%s\n" % (user_id, stage, doc_id, outcome))
+    self._handle.flush()
+    if outcome in FINISHED_OUTCOMES:
+      self._doc_ids(user_id, stage).add(doc_id)
+
+
+  def close(self):
+    if self._handle is not None and self._pid == os.getpid():
+      self._handle.close()
+    self._handle = None
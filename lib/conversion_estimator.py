@@ -0,0 +1,151 @@
+import logging
+import itertools
+from contextlib import contextmanager
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from doc_count_util import DocumentCounts
+from hue_converters import DocumentConverterHueScripts
+from conversion_stats import ConversionStats
+
+LOG = logging.getLogger(__name__)
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+STAGES = ('saved_query', 'query_history', 'workflow', 'pigscript')
+
+# Stages timed inside one of STAGES, their time is already counted there
+NESTED_STAGES = ('dedupe',)
+
+
+class _Rollback(Exception):
+  pass
+
+
+@contextmanager
+def _rolled_back():
+  """
+  Runs the block in a transaction that is always rolled back
+  """
+  try:
+    with transaction.atomic():
+      yield
+      raise _Rollback()
+  except _Rollback:
+    pass
+
+
+class _SampleConverter(DocumentConverterHueScripts):
+  """
+  Converter that only converts the first doc_limit docs of each stage
+  """
+
+  def __init__(self, user, doc_limit, **options):
+    DocumentConverterHueScripts.__init__(self, user, **options)
+    self.doc_limit = doc_limit
+
+
+  def _iter_docs(self, docs, newest_first=False):
+    return itertools.islice(DocumentConverterHueScripts._iter_docs(self, docs, newest_first=newest_first), self.doc_limit)
+
+
+class DocumentConversionEstimator(object):
+  """
+  Dry run of DocumentConversionRunner, counts the pending docs of every user and times a sample conversion
+  in a rolled back transaction to project the runtime and DB writes of the full conversion. The sample converts the
+  first docs of each stage of the users with the most pending docs, so it works however many docs users have.
+  """
+
+  SAMPLE_USERS = 5
+
+  def __init__(self, usernames, sample_docs=200, workers=1, history_batch_size=None):
+    self.usernames = usernames
+    self.sample_docs = sample_docs
+    self.workers = max(workers or 1, 1)
+    self.history_batch_size = history_batch_size
+
+
+  def _get_users(self):
+    if not self.usernames:
+      users = User.objects.all()
+    else:
+      userlist = self.usernames.split(",")
+      users = User.objects.filter(username__in = userlist)
+    return users.order_by('id')
+
+
+  def _count_docs(self, counts):
+    # The history loop converts saved queries as well, so query_history already includes them
+    return counts['saved_query'] + counts['query_history'] + counts['workflow'] + counts['pigscript']
+
+
+  def _time_sample(self, user, doc_limit):
+    """
+    Converts the first doc_limit docs of each stage of the user and rolls back, returns (stage stats, write statements)
+    """
+    stats = ConversionStats()
+    with _rolled_back():
+      with CaptureQueriesContext(connection) as queries:
+        converter = _SampleConverter(user, doc_limit, history_batch_size = self.history_batch_size, stats = stats)
+        converter.convertfailed()
+    writes = len([query for query in queries.captured_queries if query['sql'].lstrip().upper().startswith(WRITE_STATEMENTS)])
+    return stats, writes
+
+
+  def estimate(self):
+    totals = dict((stage, 0) for stage in STAGES)
+    user_docs = []
+
+    for user in self._get_users():
+      # Tag lookups may create missing reserved tags, keep counting read only
+      with _rolled_back():
+        counts = DocumentCounts(user).getPendingCounts()
+      pending = self._count_docs(counts)
+      if not pending:
+        continue
+      LOG.info("%-30s saved queries: %s history: %s workflows: %s pig scripts: %s" % (user.username, counts['saved_query'], counts['query_history'], counts['workflow'], counts['pigscript']))
+      for key in totals:
+        totals[key] += counts[key]
+      user_docs.append((pending, user.id, user))
+
+    total_docs = self._count_docs(totals)
+    LOG.info("Pending docs: saved queries: %s history: %s workflows: %s pig scripts: %s total: %s" % (totals['saved_query'], totals['query_history'], totals['workflow'], totals['pigscript'], total_docs))
+
+    if not total_docs:
+      LOG.info("Nothing to convert")
+      return
+
+    # Sample the first docs of the largest users, they dominate the runtime
+    sample_users = [user for pending, user_id, user in sorted(user_docs, reverse=True)[:self.SAMPLE_USERS]]
+    doc_limit = max(self.sample_docs // (len(sample_users) * len(STAGES)), 1)
+    sample = ConversionStats()
+    sample_writes = 0
+    for user in sample_users:
+      stats, writes = self._time_sample(user, doc_limit)
+      sample.merge(stats.stages)
+      sample_writes += writes
+
+    sampled_docs = sum(sample.stages[stage]['documents'] for stage in STAGES if stage in sample.stages)
+    sample_elapsed = sum(sample.stages[stage]['seconds'] for stage in STAGES if stage in sample.stages)
+    if not sampled_docs:
+      LOG.warn("No doc could be converted in the sample, cannot project runtime")
+      return
+
+    # Stages differ a lot in cost per doc, project each with its own rate and fall back to the overall one
+    seconds_per_doc = sample_elapsed / sampled_docs
+    projected = 0
+    for stage in STAGES:
+      stage_stats = sample.stages.get(stage)
+      if stage_stats and stage_stats['documents']:
+        projected += totals[stage] * stage_stats['seconds'] / stage_stats['documents']
+      else:
+        projected += totals[stage] * seconds_per_doc
+
+    # Permissions and the trash move run once per user whatever the number of docs
+    user_elapsed = sum(stats['seconds'] for stage, stats in sample.stages.items() if stage not in STAGES + NESTED_STAGES)
+    projected += user_elapsed / len(sample_users) * len(user_docs)
+
+    writes_per_doc = float(sample_writes) / sampled_docs
+    LOG.info("Sample: %s docs of %s users converted and rolled back in %.2f seconds with %s write statements" % (sampled_docs, len(sample_users), sample_elapsed + user_elapsed, sample_writes))
+    LOG.info("Projected runtime (minutes): %.2f with %s workers" % (projected / self.workers / 60, self.workers))
+    LOG.info("Projected write statements: %d" % (writes_per_doc * total_docs))
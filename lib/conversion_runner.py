@@ -1,51 +1,210 @@
+import json
 import time
 import logging
+import multiprocessing
 from django.contrib.auth.models import User
-from hue_converters import DocumentConverterHueScripts
+from django.db import connections
+from hue_converters import DocumentConverterHueScripts, TRANSIENT_DB_ERRORS
+from conversion_checkpoint import ConversionCheckpoint
+from conversion_stats import ConversionStats
 
 LOG = logging.getLogger(__name__)
 
+# Checkpoint journal shared with forked workers, loaded once by the parent
+_checkpoint = None
+
+def _close_db_connections():
+  # Forked workers must not share the parent's DB socket, Django reconnects lazily
+  for conn in connections.all():
+    conn.close()
+
+
+def _init_worker(checkpoint):
+  global _checkpoint
+  _checkpoint = checkpoint
+  _close_db_connections()
+
+
+def _convert_user(user_id, username, processdocs, options, count_queries=False, retries=0, retry_backoff=5):
+  """
+  Converts the docs of a single user, options are passed on to DocumentConverterHueScripts. Transient DB errors are
+      retried up to retries times, waiting retry_backoff seconds doubled on every attempt. Any other error only fails
+      this user.
+  Returns (username, elapsed seconds, status, processdocs, stage stats)
+  """
+  LOG.info("Converting docs for user: %s" % username)
+  start = time.time()
+  attempt = 0
+  while True:
+    # A failed attempt's timings are dropped so retried users are not counted twice in the report
+    stats = ConversionStats(count_queries=count_queries)
+    try:
+      user = User.objects.get(id=user_id)
+      converter = DocumentConverterHueScripts(user, processdocs = processdocs, checkpoint = _checkpoint, stats = stats, **options)
+      processdocs = converter.convertfailed()
+      # Failed docs are journaled, listing the user in the retry file lets a --checkpoint run retry only them
+      if converter.failed:
+        LOG.warn("Conversions failed for %s docs of user: %s" % (converter.failed, username))
+        status = "failed"
+      else:
+        status = "ok"
+      break
+    except TRANSIENT_DB_ERRORS, e:
+      if attempt >= retries:
+        LOG.warn("Conversions failed for user: %s after %s attempts: %s" % (username, attempt + 1, e))
+        status = "failed"
+        break
+      attempt += 1
+      wait = retry_backoff * 2 ** (attempt - 1)
+      LOG.warn("Transient DB error for user: %s, retry %s of %s in %s seconds: %s" % (username, attempt, retries, wait, e))
+      _close_db_connections()
+      time.sleep(wait)
+    except Exception, e:
+      LOG.exception("Conversions failed for user: %s" % username)
+      status = "failed"
+      break
+  end = time.time()
+  elapsed = end - start
+  LOG.info("Finished user: %s : elapsed time: %s" % (username, elapsed / 60))
+  return (username, elapsed, status, processdocs, stats.stages)
+
+
+def _convert_user_worker(args):
+  return _convert_user(*args)
+
+
 class DocumentConversionRunner(object):
   """
   Given a user, converts any existing Document objects to Document2 objects
   """
 
-  def __init__(self, usernames, allowdupes=False, startqueryname=None, startuser=None):
+  def __init__(self, usernames, allowdupes=False, startqueryname=None, startuser=None, workers=1, checkpoint=None, history_batch_size=None, report=None,
+               retries=3, retry_backoff=5, retry_file=None):
     self.usernames = usernames
     self.allowdupes = allowdupes
     self.startqueryname = startqueryname
     self.startuser = startuser
+    self.workers = max(workers or 1, 1)
+    self.checkpoint = checkpoint
+    self.history_batch_size = history_batch_size
+    self.report = report
+    self.retries = retries
+    self.retry_backoff = retry_backoff
+    self.retry_file = retry_file
+    self.timings = []
+    self.stats = ConversionStats(count_queries=self.report is not None)
 
 
-  def runconversions(self):
+  def _converter_options(self):
+    return {
+      'allowdupes': self.allowdupes,
+      'startqueryname': self.startqueryname,
+      'startuser': self.startuser,
+      'history_batch_size': self.history_batch_size,
+    }
+
+
+  def _get_users(self):
     if not self.usernames:
       users = User.objects.all()
     else:
       userlist = self.usernames.split(",")
       users = User.objects.filter(username__in = userlist)
+    return users.order_by('id')
+
+
+  def _retry_options(self):
+    # Without a checkpoint a retry would convert the docs finished before the failure a second time
+    if not self.checkpoint:
+      return (0, self.retry_backoff)
+    return (self.retries, self.retry_backoff)
+
+
+  def runconversions(self):
+    global _checkpoint
+    if self.checkpoint:
+      _checkpoint = ConversionCheckpoint(self.checkpoint)
+    elif self.retries:
+      LOG.warn("Not retrying users after transient DB errors as no --checkpoint is used, failed users go to the retry file")
+
+    users = self._get_users()
 
     if self.startqueryname or self.startuser:
       processdocs = False
     else:
       processdocs = True
 
-    LOG.info("Converting docs for %s users" % users.count())
-    for user in users:
+    user_ids = list(users.values_list('id', 'username'))
+    LOG.info("Converting docs for %s users" % len(user_ids))
 
-      LOG.info("Converting docs for user: %s" % user.username)
-      if user.username == self.startuser:
+    # Resume point has to be found in order, so walk users serially until processing starts
+    remaining = []
+    for index, (user_id, username) in enumerate(user_ids):
+      if processdocs and self.workers > 1:
+        remaining = user_ids[index:]
+        break
+      if username == self.startuser:
         processdocs = True
+      timing = _convert_user(user_id, username, processdocs, self._converter_options(), self.report is not None, *self._retry_options())
+      processdocs = timing[3]
+      self.add_timing(timing)
 
-      start = time.time()
-
+    if remaining:
+      LOG.info("Converting docs for remaining %s users with %s workers" % (len(remaining), self.workers))
+      _close_db_connections()
+      pool = multiprocessing.Pool(processes=self.workers, initializer=_init_worker, initargs=(_checkpoint,))
       try:
-        converter = DocumentConverterHueScripts(user, allowdupes = self.allowdupes, startqueryname = self.startqueryname, startuser = self.startuser, processdocs = processdocs)
-        processdocs = converter.convertfailed()
-      except:
-        LOG.warn("Conversions failed for user: %s" % user.username)
-      end = time.time()
-      elapsed = (end - start) / 60
-      LOG.info("Finished user: %s : elapsed time: %s" % (user.username, elapsed))
+        tasks = [(user_id, username, True, self._converter_options(), self.report is not None) + self._retry_options() for user_id, username in remaining]
+        for timing in pool.imap_unordered(_convert_user_worker, tasks):
+          self.add_timing(timing)
+      finally:
+        pool.close()
+        pool.join()
+
+    if _checkpoint is not None:
+      _checkpoint.close()
+    self.log_timings()
+    if self.report:
+      self.write_report()
+    if self.retry_file:
+      self.write_retry_file()
+
+
+  def add_timing(self, timing):
+    self.timings.append(timing[:4])
+    self.stats.merge(timing[4])
+
+
+  def write_report(self):
+    """
+    Writes the merged per stage stats and per user timings as JSON
+    """
+    report = self.stats.report()
+    report['users'] = [{'username': username, 'seconds': elapsed, 'status': status} for username, elapsed, status, processdocs in self.timings]
+    with open(self.report, 'w') as report_file:
+      json.dump(report, report_file, indent=2, sort_keys=True)
+    LOG.info("Wrote conversion report to: %s" % self.report)
+
 
+  def write_retry_file(self):
+    """
+    Writes the failed users one per line, the file can be passed back with --usernames-file
+    """
+    failed = [username for username, elapsed, status, processdocs in self.timings if status != "ok"]
+    with open(self.retry_file, 'w') as retry_file:
+      for username in failed:
+        retry_file.write("%s\n" % username)
+    LOG.info("Wrote %s failed users to retry file: %s" % (len(failed), self.retry_file))
 
 
+  def log_timings(self):
+    """
+    Logs one merged per-user timing report, slowest users first
+    """
+    total = sum(timing[1] for timing in self.timings)
+    failed = [timing[0] for timing in self.timings if timing[2] != "ok"]
+    LOG.info("Conversion timing report: %s users, %s failed, total user time (minutes): %.2f" % (len(self.timings), len(failed), total / 60))
+    for username, elapsed, status, processdocs in sorted(self.timings, key=lambda timing: timing[1], reverse=True):
+      LOG.info("%-30s %-8s %10.2f" % (username, status, elapsed))
+    if failed:
+      LOG.warn("Conversions failed for users: %s" % ",".join(failed))
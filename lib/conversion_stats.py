@@ -0,0 +1,106 @@
+import time
+import logging
+from contextlib import contextmanager
+from django.db import connection, reset_queries
+
+LOG = logging.getLogger(__name__)
+
+# Upper bounds in milliseconds of the per document latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# connection.queries is capped on newer Django versions, reset it well before the cap so no query is missed
+_QUERY_LOG_RESET = 5000
+
+
+class ConversionStats(object):
+  """
+  Per stage timers, query counts and per document latency histograms of a conversion run.
+  Stats are kept as plain dicts so they can be returned from worker processes and merged.
+  """
+
+  def __init__(self, count_queries=False):
+    self.stages = {}
+    self.count_queries = count_queries
+    self._query_offset = 0
+    if count_queries:
+      enable_query_log()
+
+
+  def _query_count(self):
+    if not self.count_queries:
+      return 0
+    count = len(connection.queries)
+    if count > _QUERY_LOG_RESET:
+      self._query_offset += count
+      reset_queries()
+      count = 0
+    return self._query_offset + count
+
+
+  def _get_stage(self, name):
+    if name not in self.stages:
+      self.stages[name] = {'seconds': 0.0, 'queries': 0, 'calls': 0, 'documents': 0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+    return self.stages[name]
+
+
+  @contextmanager
+  def stage(self, name):
+    """
+    Times a stage of the conversion, nested stages are also counted in the enclosing one
+    """
+    stage = self._get_stage(name)
+    start = time.time()
+    queries = self._query_count()
+    try:
+      yield
+    finally:
+      stage['seconds'] += time.time() - start
+      stage['queries'] += self._query_count() - queries
+      stage['calls'] += 1
+
+
+  @contextmanager
+  def document(self, name):
+    """
+    Adds the latency of converting one document to the histogram of a stage
+    """
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(name, time.time() - start)
+      # Stages without nested stages would otherwise only reset connection.queries when they end
+      self._query_count()
+
+
+  def observe(self, name, seconds):
+    stage = self._get_stage(name)
+    stage['documents'] += 1
+    milliseconds = seconds * 1000
+    bucket = 0
+    while bucket < len(LATENCY_BUCKETS) and milliseconds > LATENCY_BUCKETS[bucket]:
+      bucket += 1
+    stage['histogram'][bucket] += 1
+
+
+  def merge(self, stages):
+    for name, other in stages.items():
+      stage = self._get_stage(name)
+      for key in ('seconds', 'queries', 'calls', 'documents'):
+        stage[key] += other[key]
+      stage['histogram'] = [count + other_count for count, other_count in zip(stage['histogram'], other['histogram'])]
+
+
+  def report(self):
+    buckets = ["<=%sms" % bucket for bucket in LATENCY_BUCKETS] + [">%sms" % LATENCY_BUCKETS[-1]]
+    return {
+      'latency_buckets': buckets,
+      'query_counts': self.count_queries,
+      'stages': self.stages,
+    }
+
+
+def enable_query_log():
+  # Django only records connection.queries with a debug cursor, the attribute was renamed in 1.8
+  connection.force_debug_cursor = True
+  connection.use_debug_cursor = True
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import FieldError
+from django.utils.translation import ugettext_lazy as _t, ugettext as _
+from django.contrib.auth.models import User
+
+from doc2_utils import backfillIsTrashed
+
+import desktop.conf
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+  """
+  Handler for setting is_trashed on Document2 objects where it is still empty
+  """
+
+  try:
+    from optparse import make_option
+    option_list = BaseCommand.option_list + (
+      make_option("--username", help=_t("Only backfill the docs of this user, defaults to all users."),
+                  action="store", default=None, dest='username'),
+    )
+
+  except AttributeError, e:
+    baseoption_test = 'BaseCommand' in str(e) and 'option_list' in str(e)
+    if baseoption_test:
+      def add_arguments(self, parser):
+        parser.add_argument("--username", help=_t("Only backfill the docs of this user, defaults to all users."),
+                    action="store", default=None, dest='username')
+
+    else:
+      LOG.exception(str(e))
+      sys.exit(1)
+
+
+  def handle(self, *args, **options):
+    LOG.info("Setting is_trashed for Document2 objects with is_trashed=None")
+
+    start = time.time()
+
+    owner = None
+    if options['username']:
+      owner = User.objects.get(username = options['username'])
+
+    try:
+      updated = backfillIsTrashed(owner=owner)
+      LOG.info("Set is_trashed on %s docs" % updated)
+    except FieldError, e:
+      LOG.info("Skipping is_trashed as does not exist in this version")
+
+    end = time.time()
+    elapsed = (end - start)
+    LOG.info("Total time elapsed (seconds): %.2f" % elapsed)
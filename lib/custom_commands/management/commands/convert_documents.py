@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+import os
+import sys
+import time
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import ugettext_lazy as _t, ugettext as _
+
+from conversion_runner import DocumentConversionRunner
+from conversion_estimator import DocumentConversionEstimator
+from conversion_checkpoint import ConversionCheckpoint
+from global_conversion import GlobalDocumentConverter
+from hue_converters import TRANSIENT_DB_ERRORS
+
+import desktop.conf
+
+logging.basicConfig()
+LOG = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+  """
+  Handler for converting Document objects to Document2 objects
+  """
+
+  try:
+    from optparse import make_option
+    option_list = BaseCommand.option_list + (
+      make_option("--usernames", help=_t("Comma separated list of users to convert, defaults to all users."),
+                  action="store", default=None, dest='usernames'),
+      make_option("--usernames-file", help=_t("File with one user to convert per line, such as a retry file."),
+                  action="store", default=None, dest='usernames_file'),
+      make_option("--allowdupes", help=_t("Convert queries even if a matching Document2 already exists."),
+                  action="store_true", default=False, dest='allowdupes'),
+      make_option("--startqueryname", help=_t("Resume conversion at the first query matching this name."),
+                  action="store", default=None, dest='startqueryname'),
+      make_option("--startuser", help=_t("Resume conversion at this user."),
+                  action="store", default=None, dest='startuser'),
+      make_option("--workers", help=_t("Number of processes converting users in parallel."),
+                  action="store", type=int, default=1, dest='workers'),
+      make_option("--checkpoint", help=_t("Journal file of converted docs, finished docs in it are skipped on restart."),
+                  action="store", default=None, dest='checkpoint'),
+      make_option("--history-batch-size", help=_t("Convert query history with bulk inserts of this many docs, 0 converts one doc at a time."),
+                  action="store", type=int, default=0, dest='history_batch_size'),
+      make_option("--estimate", help=_t("Only count pending docs and project the conversion runtime, nothing is converted."),
+                  action="store_true", default=False, dest='estimate'),
+      make_option("--estimate-sample-docs", help=_t("Number of docs converted and rolled back to time the conversion."),
+                  action="store", type=int, default=200, dest='estimate_sample_docs'),
+      make_option("--report", help=_t("Write per stage timings, query counts and latency histograms to this JSON file."),
+                  action="store", default=None, dest='report'),
+      make_option("--global", help=_t("Convert the saved queries and history of all users in id order instead of user by user."),
+                  action="store_true", default=False, dest='global_conversion'),
+      make_option("--retries", help=_t("Number of times a user is retried after a transient DB error, 3 by default, needs --checkpoint."),
+                  action="store", type=int, default=None, dest='retries'),
+      make_option("--retry-backoff", help=_t("Seconds to wait before the first retry, 5 by default, doubled on every retry."),
+                  action="store", type=int, default=None, dest='retry_backoff'),
+      make_option("--retry-file", help=_t("Write users whose conversion failed to this file, one per line."),
+                  action="store", default=None, dest='retry_file'),
+    )
+
+  except AttributeError, e:
+    baseoption_test = 'BaseCommand' in str(e) and 'option_list' in str(e)
+    if baseoption_test:
+      def add_arguments(self, parser):
+        parser.add_argument("--usernames", help=_t("Comma separated list of users to convert, defaults to all users."),
+                    action="store", default=None, dest='usernames')
+        parser.add_argument("--usernames-file", help=_t("File with one user to convert per line, such as a retry file."),
+                    action="store", default=None, dest='usernames_file')
+        parser.add_argument("--allowdupes", help=_t("Convert queries even if a matching Document2 already exists."),
+                    action="store_true", default=False, dest='allowdupes')
+        parser.add_argument("--startqueryname", help=_t("Resume conversion at the first query matching this name."),
+                    action="store", default=None, dest='startqueryname')
+        parser.add_argument("--startuser", help=_t("Resume conversion at this user."),
+                    action="store", default=None, dest='startuser')
+        parser.add_argument("--workers", help=_t("Number of processes converting users in parallel."),
+                    action="store", type=int, default=1, dest='workers')
+        parser.add_argument("--checkpoint", help=_t("Journal file of converted docs, finished docs in it are skipped on restart."),
+                    action="store", default=None, dest='checkpoint')
+        parser.add_argument("--history-batch-size", help=_t("Convert query history with bulk inserts of this many docs, 0 converts one doc at a time."),
+                    action="store", type=int, default=0, dest='history_batch_size')
+        parser.add_argument("--estimate", help=_t("Only count pending docs and project the conversion runtime, nothing is converted."),
+                    action="store_true", default=False, dest='estimate')
+        parser.add_argument("--estimate-sample-docs", help=_t("Number of docs converted and rolled back to time the conversion."),
+                    action="store", type=int, default=200, dest='estimate_sample_docs')
+        parser.add_argument("--report", help=_t("Write per stage timings, query counts and latency histograms to this JSON file."),
+                    action="store", default=None, dest='report')
+        parser.add_argument("--global", help=_t("Convert the saved queries and history of all users in id order instead of user by user."),
+                    action="store_true", default=False, dest='global_conversion')
+        parser.add_argument("--retries", help=_t("Number of times a user is retried after a transient DB error, 3 by default, needs --checkpoint."),
+                    action="store", type=int, default=None, dest='retries')
+        parser.add_argument("--retry-backoff", help=_t("Seconds to wait before the first retry, 5 by default, doubled on every retry."),
+                    action="store", type=int, default=None, dest='retry_backoff')
+        parser.add_argument("--retry-file", help=_t("Write users whose conversion failed to this file, one per line."),
+                    action="store", default=None, dest='retry_file')
+
+    else:
+      LOG.exception(str(e))
+      sys.exit(1)
+
+
+  # Options of the user by user conversion that --global cannot honour
+  USER_OPTIONS = ('usernames', 'usernames_file', 'startqueryname', 'startuser', 'report', 'retries', 'retry_backoff', 'retry_file')
+
+
+  def handle(self, *args, **options):
+    LOG.info("Converting Document objects to Document2 objects")
+
+    start = time.time()
+
+    if options['global_conversion']:
+      conflicting = [name for name in self.USER_OPTIONS if options[name] is not None]
+      if options['workers'] != 1:
+        conflicting.append('workers')
+      if options['estimate']:
+        conflicting.append('estimate')
+      if conflicting:
+        raise CommandError("--global converts every user and cannot be combined with: %s" %
+                           ", ".join("--" + name.replace('_', '-') for name in conflicting))
+
+    if options['usernames_file']:
+      with open(options['usernames_file']) as usernames_file:
+        usernames = [line.strip() for line in usernames_file if line.strip()]
+      if not usernames:
+        LOG.info("No users in %s, nothing to convert" % options['usernames_file'])
+        return
+      options['usernames'] = ",".join(usernames)
+
+    if options['estimate']:
+      LOG.info("Estimating conversion, nothing will be converted")
+      estimator = DocumentConversionEstimator(options['usernames'], sample_docs=options['estimate_sample_docs'],
+                                              workers=options['workers'], history_batch_size=options['history_batch_size'])
+      estimator.estimate()
+      return
+
+    if options['global_conversion']:
+      LOG.info("Converting saved queries and history of all users in id order")
+      checkpoint = ConversionCheckpoint(options['checkpoint']) if options['checkpoint'] else None
+      converter = GlobalDocumentConverter(allowdupes=options['allowdupes'], checkpoint=checkpoint,
+                                          history_batch_size=options['history_batch_size'])
+      try:
+        converter.convert()
+      except TRANSIENT_DB_ERRORS, e:
+        raise CommandError("Stopped on a DB error, run again with the same --checkpoint to resume: %s" % e)
+      finally:
+        if checkpoint is not None:
+          checkpoint.close()
+    else:
+      runner = DocumentConversionRunner(options['usernames'], allowdupes=options['allowdupes'],
+                                        startqueryname=options['startqueryname'], startuser=options['startuser'],
+                                        workers=options['workers'], checkpoint=options['checkpoint'],
+                                        history_batch_size=options['history_batch_size'], report=options['report'],
+                                        retries=options['retries'] if options['retries'] is not None else 3,
+                                        retry_backoff=options['retry_backoff'] if options['retry_backoff'] is not None else 5,
+                                        retry_file=options['retry_file'])
+      runner.runconversions()
+
+    end = time.time()
+    elapsed = (end - start) / 60
+    LOG.info("Total time elapsed (minutes): %.2f" % elapsed)
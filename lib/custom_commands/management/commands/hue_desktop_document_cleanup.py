@@ -11,9 +11,14 @@ from beeswax.models import SavedQuery
 from beeswax.models import Session
 from datetime import date, timedelta
 from oozie.models import Workflow
-from django.db.utils import DatabaseError
+from django.db.models import Max
 import desktop.conf
 from desktop.models import Document2
+from purge_engine import BatchPurger, LatencyThrottle, RateLimiter, parallel_purge, split_by_pk
+from doc2_purge import Document2Purger
+from purge_watermark import PurgeWatermarks
+from purge_archive import PurgeArchiver
+from orphan_scan import purge_orphans
 import logging
 import logging.handlers
 
@@ -35,6 +40,64 @@ class Command(BaseCommand):
                     action="store",
                     type=int,
                     default=30),
+            make_option("--batch-size", help=_t("Number of records deleted in the first batch."),
+                    action="store",
+                    type=int,
+                    default=999),
+            make_option("--max-batch-size", help=_t("Largest number of records deleted in one batch."),
+                    action="store",
+                    type=int,
+                    default=999),
+            make_option("--target-latency", help=_t("Seconds a delete batch should take, batches grow when faster and shrink when slower."),
+                    action="store",
+                    type=float,
+                    default=1.0),
+            make_option("--parallel", help=_t("Number of tables or id ranges purged at the same time, each with its own DB connection."),
+                    action="store",
+                    type=int,
+                    default=1),
+            make_option("--partitions", help=_t("Number of id ranges each table is split into when purging in parallel."),
+                    action="store",
+                    type=int,
+                    default=1),
+            make_option("--max-rows-per-second", help=_t("Limit on the rows deleted per second across all parallel purges, 0 for no limit."),
+                    action="store",
+                    type=int,
+                    default=0),
+            make_option("--set-based-delete", help=_t("Delete history Doc2 objects and their dependent rows with SQL subqueries instead of through the ORM."),
+                    action="store_true",
+                    default=False),
+            make_option("--latency-budget", help=_t("Pause and shrink batches when a delete takes longer than this many seconds, 0 to disable."),
+                    action="store",
+                    type=float,
+                    default=0),
+            make_option("--response-time-budget", help=_t("Pause and shrink batches while Hue's aggregate response time is above this many seconds, 0 to disable."),
+                    action="store",
+                    type=float,
+                    default=0),
+            make_option("--throttle-pause", help=_t("Seconds to pause when over budget, doubled while it stays over budget."),
+                    action="store",
+                    type=int,
+                    default=5),
+            make_option("--metrics-file", help=_t("Hue metrics sample file, defaults to the [desktop] [[metrics]] location of hue.ini."),
+                    action="store",
+                    default=None),
+            make_option("--watermark-file", help=_t("File keeping the lowest id still to purge per table, later runs only scan ids above it."),
+                    action="store",
+                    default=None),
+            make_option("--full-scan", help=_t("Ignore the ids in --watermark-file and scan the whole tables, then store new watermarks."),
+                    action="store_true",
+                    default=False),
+            make_option("--archive-dir", help=_t("Directory to write the purged rows to as gzipped JSON lines before deleting them."),
+                    action="store",
+                    default=None),
+            make_option("--archive-rows-per-file", help=_t("Number of rows written to an archive file before starting the next one."),
+                    action="store",
+                    type=int,
+                    default=1000000),
+            make_option("--purge-orphans", help=_t("Also delete DocumentPermission and UserPreferences rows whose document or user no longer exists."),
+                    action="store_true",
+                    default=False),
         )
 
     except AttributeError, e:
@@ -45,45 +108,137 @@ class Command(BaseCommand):
                     action="store",
                     type=int,
                     default=30)
+                parser.add_argument("--batch-size", help=_t("Number of records deleted in the first batch."),
+                    action="store",
+                    type=int,
+                    default=999)
+                parser.add_argument("--max-batch-size", help=_t("Largest number of records deleted in one batch."),
+                    action="store",
+                    type=int,
+                    default=999)
+                parser.add_argument("--target-latency", help=_t("Seconds a delete batch should take, batches grow when faster and shrink when slower."),
+                    action="store",
+                    type=float,
+                    default=1.0)
+                parser.add_argument("--parallel", help=_t("Number of tables or id ranges purged at the same time, each with its own DB connection."),
+                    action="store",
+                    type=int,
+                    default=1)
+                parser.add_argument("--partitions", help=_t("Number of id ranges each table is split into when purging in parallel."),
+                    action="store",
+                    type=int,
+                    default=1)
+                parser.add_argument("--max-rows-per-second", help=_t("Limit on the rows deleted per second across all parallel purges, 0 for no limit."),
+                    action="store",
+                    type=int,
+                    default=0)
+                parser.add_argument("--set-based-delete", help=_t("Delete history Doc2 objects and their dependent rows with SQL subqueries instead of through the ORM."),
+                    action="store_true",
+                    default=False)
+                parser.add_argument("--latency-budget", help=_t("Pause and shrink batches when a delete takes longer than this many seconds, 0 to disable."),
+                    action="store",
+                    type=float,
+                    default=0)
+                parser.add_argument("--response-time-budget", help=_t("Pause and shrink batches while Hue's aggregate response time is above this many seconds, 0 to disable."),
+                    action="store",
+                    type=float,
+                    default=0)
+                parser.add_argument("--throttle-pause", help=_t("Seconds to pause when over budget, doubled while it stays over budget."),
+                    action="store",
+                    type=int,
+                    default=5)
+                parser.add_argument("--metrics-file", help=_t("Hue metrics sample file, defaults to the [desktop] [[metrics]] location of hue.ini."),
+                    action="store",
+                    default=None)
+                parser.add_argument("--watermark-file", help=_t("File keeping the lowest id still to purge per table, later runs only scan ids above it."),
+                    action="store",
+                    default=None)
+                parser.add_argument("--full-scan", help=_t("Ignore the ids in --watermark-file and scan the whole tables, then store new watermarks."),
+                    action="store_true",
+                    default=False)
+                parser.add_argument("--archive-dir", help=_t("Directory to write the purged rows to as gzipped JSON lines before deleting them."),
+                    action="store",
+                    default=None)
+                parser.add_argument("--archive-rows-per-file", help=_t("Number of rows written to an archive file before starting the next one."),
+                    action="store",
+                    type=int,
+                    default=1000000)
+                parser.add_argument("--purge-orphans", help=_t("Also delete DocumentPermission and UserPreferences rows whose document or user no longer exists."),
+                    action="store_true",
+                    default=False)
         else:
             LOG.exception(str(e))
             sys.exit(1)
 
 
+    def watermarkKey(self, objClass, filterType, filterValue):
+        #Workflows can be trashed or renamed long after they were created, below the watermark, so they are always fully scanned
+        if self.watermarks is None or objClass is Workflow:
+            return None
+        return "%s.%s=%s" % (objClass.__name__, filterType, filterValue)
+
+
+    def cleanupQueryset(self, objClass, filterType, filterValue, dateField):
+        queryset = objClass.objects.filter(**{ '%s' % filterType: filterValue, '%s__lte' % dateField: self.timeDeltaObj, })
+        key = self.watermarkKey(objClass, filterType, filterValue)
+        if key is not None and not self.fullScan and self.watermarks.get(key) is not None:
+            LOG.info("Scanning %s objects from id %s" % (objClass.__name__, self.watermarks.get(key)))
+            queryset = queryset.filter(pk__gte=self.watermarks.get(key))
+        return queryset
+
+
+    def updateWatermark(self, objClass, filterType, filterValue, dateField):
+        """
+        Once everything older than the cutoff is deleted, the first remaining row matching the filter is where the
+        next run has to start.
+        """
+        key = self.watermarkKey(objClass, filterType, filterValue)
+        if key is None:
+            return
+        remaining = objClass.objects.filter(**{ '%s' % filterType: filterValue })
+        if self.watermarks.get(key) is not None and not self.fullScan:
+            remaining = remaining.filter(pk__gte=self.watermarks.get(key))
+        first = list(remaining.order_by('pk').values_list('pk', flat=True)[:1])
+        if first:
+            mark = first[0]
+        else:
+            #Nothing left matching the filter, new rows will get ids above the current ones
+            mark = (objClass.objects.aggregate(high=Max('pk'))['high'] or 0) + 1
+        LOG.info("%s watermark: %s" % (key, mark))
+        self.watermarks.set(key, mark, self.timeDeltaObj)
+
+
+    def purgerOptions(self):
+        return {
+            'batch_size': self.deleteRecordsBase,
+            'max_batch_size': self.deleteRecordsMax,
+            'target_latency': self.targetLatency,
+            'rate_limiter': self.rateLimiter,
+            'throttle': self.throttle,
+            'archiver': self.archiver,
+        }
+
+
+    def makePurger(self, queryset, **options):
+        if self.setBasedDelete and queryset.model is Document2:
+            return Document2Purger(queryset, **options)
+        return BatchPurger(queryset, **options)
+
+
     def objectCleanup(self, objClass, filterType, filterValue, dateField):
-        errorCount = 0
-        checkCount = 0
-        resets = 0
-        deleteRecords = self.deleteRecordsBase
-
-        totalObjects = objClass.objects.filter(**{ '%s' % filterType: filterValue, '%s__lte' % dateField: self.timeDeltaObj, })\
-                                                .values_list("id", flat=True)
-        LOG.info("Looping through %s objects. %s objects to be deleted." % (objClass.__name__, totalObjects.count()))
-        while totalObjects.count():
-            if deleteRecords < 30 and resets < self.resetMax:
-                checkCount += 1
-            if checkCount == self.resetCount:
-                deleteRecords = self.deleteRecordsBase
-                resets += 1
-                checkCount = 0
-            LOG.info("%s objects left: %s" % (objClass.__name__, totalObjects.count()))
-            deleteObjects = objClass.objects.filter(**{ '%s' % filterType: filterValue, '%s__lte' % dateField: self.timeDeltaObj, })\
-                                                    .values_list("id", flat=True)[:deleteRecords]
-            try:
-                objClass.objects.filter(pk__in=list(deleteObjects)).delete()
-                errorCount = 0
-            except DatabaseError, e:
-                LOG.info("Non Fatal Exception: %s: %s" % (e.__class__.__name__, e))
-                errorCount += 1
-                if errorCount > 9 and deleteRecords == 1:
-                    raise
-                if deleteRecords > 100:
-                    deleteRecords = max(deleteRecords - 100, 1)
-                else:
-                    deleteRecords = max(deleteRecords - 10, 1)
-                LOG.info("Decreasing max delete records to: %s" % deleteRecords)
-            totalObjects = objClass.objects.filter(**{'%s' % filterType: filterValue, '%s__lte' % dateField: self.timeDeltaObj, })\
-                                                    .values_list("id", flat=True)
+        queryset = self.cleanupQueryset(objClass, filterType, filterValue, dateField)
+        LOG.info("Looping through %s objects." % objClass.__name__)
+        purger = self.makePurger(queryset, **self.purgerOptions())
+        purger.purge()
+
+
+    def parallelCleanup(self, cleanups):
+        querysets = []
+        for cleanup in cleanups:
+            querysets += split_by_pk(self.cleanupQueryset(*cleanup), self.partitions)
+        LOG.info("Purging %s tables in %s id ranges with %s parallel connections" % (len(cleanups), len(querysets), self.parallel))
+        deleted = parallel_purge(querysets, self.parallel, make_purger=self.makePurger, **self.purgerOptions())
+        LOG.info("Deleted %s objects" % deleted)
 
 
     def handle(self, *args, **options):
@@ -91,30 +246,69 @@ class Command(BaseCommand):
 
         self.keepDays = options['keep_days']
         self.timeDeltaObj = date.today() - timedelta(days=self.keepDays)
-        self.resetCount = 15
-        self.resetMax = 5
-        self.deleteRecordsBase = 999  #number of documents to delete in a batch
-                                      #to avoid Non Fatal Exception: DatabaseError: too many SQL variables
+        self.deleteRecordsBase = options['batch_size']  #number of documents to delete in the first batch
+        self.deleteRecordsMax = options['max_batch_size']  #999 to avoid Non Fatal Exception: DatabaseError: too many SQL variables
+        self.targetLatency = options['target_latency']
+        self.parallel = options['parallel']
+        self.partitions = options['partitions']
+        self.setBasedDelete = options['set_based_delete']
+        self.rateLimiter = None
+        if options['max_rows_per_second']:
+            self.rateLimiter = RateLimiter(options['max_rows_per_second'])
+        self.fullScan = options['full_scan']
+        self.watermarks = None
+        if options['watermark_file']:
+            self.watermarks = PurgeWatermarks(options['watermark_file'])
+        self.archiver = None
+        if options['archive_dir']:
+            self.archiver = PurgeArchiver(options['archive_dir'], rows_per_file=options['archive_rows_per_file'])
+        self.throttle = None
+        if options['latency_budget'] or options['response_time_budget']:
+            metricsFile = options['metrics_file']
+            if metricsFile is None:
+                try:
+                    metricsFile = desktop.conf.METRICS.LOCATION.get()
+                except AttributeError:
+                    LOG.warn("This version of Hue has no metrics location, pass --metrics-file")
+            self.throttle = LatencyThrottle(latency_budget=options['latency_budget'], metrics_file=metricsFile,
+                                            response_time_budget=options['response_time_budget'], pause=options['throttle_pause'])
 
         LOG.info("Cleaning up anything in the Hue tables django_session, oozie*, desktop* and beeswax* older than %s old" % self.keepDays)
 
         start = time.time()
 
 
-        #Clean out Hive / Impala Query History
-        self.objectCleanup(SavedQuery, 'is_auto', True, 'mtime')
-
-        #Clear out old Hive/Impala sessions
-        self.objectCleanup(Session, 'status_code__gte', -10000, 'last_used')
+        cleanups = [
+            #Clean out Hive / Impala Query History
+            (SavedQuery, 'is_auto', True, 'mtime'),
+            #Clear out old Hive/Impala sessions
+            (Session, 'status_code__gte', -10000, 'last_used'),
+            #Clean out Trashed Workflows
+            (Workflow, 'is_trashed', True, 'last_modified'),
+            #Clean out Workflows without a name
+            (Workflow, 'name', '', 'last_modified'),
+            #Clean out history Doc2 objects
+            (Document2, 'is_history', True, 'last_modified'),
+        ]
 
-        #Clean out Trashed Workflows
-        self.objectCleanup(Workflow, 'is_trashed', True, 'last_modified')
+        try:
+            if self.parallel > 1:
+                self.parallelCleanup(cleanups)
+            else:
+                for cleanup in cleanups:
+                    self.objectCleanup(*cleanup)
 
-        #Clean out Workflows without a name
-        self.objectCleanup(Workflow, 'name', '', 'last_modified')
+            if options['purge_orphans']:
+                #Clean out permissions and preferences left behind by deleted docs and users
+                purge_orphans(self.makePurger, **self.purgerOptions())
+        finally:
+            if self.archiver is not None:
+                self.archiver.close()
 
-        #Clean out history Doc2 objects
-        self.objectCleanup(Document2, 'is_history', True, 'last_modified')
+        if self.watermarks is not None:
+            for cleanup in cleanups:
+                self.updateWatermark(*cleanup)
+            self.watermarks.save()
 
         #Clean out expired sessions
         LOG.debug("Cleaning out expired sessions from django_session table")
@@ -4,8 +4,8 @@ import logging
 
 from django.core.management.base import BaseCommand, CommandError
 from desktop.models import UserPreferences
-from django.db import models, transaction
-from django.contrib.auth.models import User
+from django.db import connection, transaction
+from purge_engine import BatchPurger
 
 
 import desktop.conf
@@ -18,25 +18,27 @@ class Command(BaseCommand):
     Handler for deleting duplicate UserPreference objects
     """
 
+    def duplicatePreferences(self):
+        """
+        Every UserPreferences row that has a row with the same user and key and a lower id, so the first preference
+        of each (user, key) survives. One self-join for the whole instance instead of one aggregate per user and key.
+        """
+        qn = connection.ops.quote_name
+        table = qn(UserPreferences._meta.db_table)
+        user_column = qn(UserPreferences._meta.get_field('user').column)
+        key_column = qn(UserPreferences._meta.get_field('key').column)
+        id_column = qn(UserPreferences._meta.pk.column)
+        where = "EXISTS (SELECT 1 FROM %(table)s survivor WHERE survivor.%(user)s = %(table)s.%(user)s AND survivor.%(key)s = %(table)s.%(key)s AND survivor.%(id)s < %(table)s.%(id)s)" % {
+            'table': table, 'user': user_column, 'key': key_column, 'id': id_column}
+        return UserPreferences.objects.extra(where=[where])
+
+
     def handle(self, *args, **options):
         LOG.warn("Deleting ducpliate UserPreference objects")
 
-        for user in User.objects.filter():
-            duplicated_records = UserPreferences.objects \
-               .values('user', 'key') \
-               .annotate(key_count=models.Count('key')) \
-               .filter(key_count__gt=1, user = user)
-            # Delete all but the first document.
-            for record in duplicated_records:
-                preferences = UserPreferences.objects \
-                    .values_list('id', flat=True) \
-                    .filter(
-                        user = user,
-                        key = record['key'],
-                    )[1:]
-                preferences = list(preferences)
-                LOG.warn("Deleting UserPreferences duplicate ids: %s" % preferences)
-                UserPreferences.objects.filter(id__in=preferences).delete()
+        duplicates = self.duplicatePreferences()
+        LOG.warn("Found %s duplicate UserPreferences objects" % duplicates.count())
+        BatchPurger(duplicates).purge()
 
 
         transaction.commit()
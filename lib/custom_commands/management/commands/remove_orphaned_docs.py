@@ -17,6 +17,8 @@ from desktop.auth.backend import find_or_create_user, rewrite_user, ensure_has_a
 from useradmin.models import get_profile, get_default_user_group, UserProfile
 from notebook.connectors.base import get_api, Notebook
 from oozie.models2 import Workflow
+from orphan_recovery import OrphanedDocumentRecovery
+from orphan_scan import count_orphans, purge_orphans
 import logging
 import logging.handlers
 
@@ -38,6 +40,12 @@ class Command(BaseCommand):
           action="store",
           type=int,
           default=30),
+      make_option("--purge-orphans", help=_t("Also delete DocumentPermission and UserPreferences rows whose document or user no longer exists."),
+          action="store_true",
+          default=False),
+      make_option("--count-orphans", help=_t("Log the number of orphaned Document, Document2, DocumentPermission and UserPreferences rows first."),
+          action="store_true",
+          default=False),
     )
 
   except AttributeError, e:
@@ -48,6 +56,12 @@ class Command(BaseCommand):
           action="store",
           type=int,
           default=30)
+        parser.add_argument("--purge-orphans", help=_t("Also delete DocumentPermission and UserPreferences rows whose document or user no longer exists."),
+          action="store_true",
+          default=False)
+        parser.add_argument("--count-orphans", help=_t("Log the number of orphaned Document, Document2, DocumentPermission and UserPreferences rows first."),
+          action="store_true",
+          default=False)
     else:
       LOG.exception(str(e))
       sys.exit(1)
@@ -58,8 +72,9 @@ class Command(BaseCommand):
 
     start = time.time()
 
-    totalUsers = User.objects.filter().values_list("id", flat=True)
-    totalDocs = Document2.objects.exclude(owner_id__in=totalUsers)
+    if options['count_orphans']:
+      count_orphans()
+
     docstorage_id = "docstorage" + str(uuid.uuid4())
     docstorage_id = docstorage_id[:30]
     LOG.info("Creating new owner for all orphaned docs: %s" % docstorage_id)
@@ -71,23 +86,10 @@ class Command(BaseCommand):
     ensure_has_a_group(docstorage)
     new_home_dir = Document2.objects.create_user_directories(docstorage)
 
-    for doc in totalDocs:
-      if not doc.type == "directory":
-        new_dir_name = "recover-" + str(doc.owner_id)
-        new_sub_dir = Directory.objects.create(name=new_dir_name, owner=docstorage, parent_directory=new_home_dir)
-        doc1 = doc.doc.get()
-        doc.owner = docstorage
-        doc1.owner = docstorage
-        doc.parent_directory = new_sub_dir
-        doc.save()
-        doc1.save()
-        Document.objects.sync()
-        LOG.info("Migrating orphaned doc: %s : %s : %s : %s : to orphaned doc owner: %s" % (doc.name, doc.type, doc.owner_id, doc.parent_directory, docstorage_id))
-
-    for doc in totalDocs:
-      if doc.type == "directory":
-        LOG.info("Deleting orphaned directory: %s : %s : %s" % (doc.name, doc.type, doc.owner_id))
-        doc.delete()
+    OrphanedDocumentRecovery(docstorage, new_home_dir).recover()
+
+    if options['purge_orphans']:
+      purge_orphans()
 
 
     end = time.time()
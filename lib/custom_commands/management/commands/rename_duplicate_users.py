@@ -6,7 +6,7 @@ import datetime
 from django.core.management.base import BaseCommand, CommandError
 from django.utils.translation import ugettext_lazy as _t, ugettext as _
 from django.contrib.auth.models import User
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 
 
@@ -31,7 +31,7 @@ class Command(BaseCommand):
     baseoption_test = 'BaseCommand' in str(e) and 'option_list' in str(e)
     if baseoption_test:
       def add_arguments(self, parser):
-        parser.add_argument("--olduser", help=_t("Rename permanent user to be all lowercase, uppercase or NONE."),
+        parser.add_argument("--renamecase", help=_t("Rename permanent user to be all lowercase, uppercase or NONE."),
                             action="store", default="lowercase", dest='renamecase')
 
     else:
@@ -39,102 +39,116 @@ class Command(BaseCommand):
       sys.exit(1)
 
 
-  def rename_user(self, rename_user=None, keep_user=None, count=None):
-    new_username = rename_user + "renamed"
-    LOG.warn("%s is newer than %s, renaming %s to %s" % (rename_user, keep_user, rename_user, new_username))
-    self.users_dict[self.username][count]["username"] = new_username
-    user_mod = User.objects.get(username=rename_user)
-    user_mod.username = new_username
-    user_mod.save()
-
-
-  def change_user_case(self, username=None, newcase=None):
-    tmp_username = username + "tmp"
+  def find_duplicate_users(self):
+    """
+    Groups all users by lowercase username in one pass, oldest first. Returns {lowercase username: [(id, username, date_joined)]}
+    for the names shared by more than one user.
+    """
+    users_by_name = {}
+    for user in User.objects.order_by('date_joined', 'id').values_list('id', 'username', 'date_joined').iterator():
+      users_by_name.setdefault(user[1].lower(), []).append(user)
+    return dict((name, users) for name, users in users_by_name.items() if len(users) > 1)
+
+
+  def rename_duplicate_users(self, duplicates):
+    """
+    Keeps the oldest user of each duplicate name and renames the newer ones to <username>renamed, in one transaction
+    """
+    taken = set(User.objects.values_list('username', flat=True))
+    renames = []
+    for name in sorted(duplicates.keys()):
+      keep_user = duplicates[name][0]
+      for user_id, username, date_joined in duplicates[name][1:]:
+        new_username = username + "renamed"
+        suffix = 1
+        while new_username in taken:
+          suffix += 1
+          new_username = "%srenamed%s" % (username, suffix)
+        taken.add(new_username)
+        LOG.warn("%s is newer than %s, renaming %s to %s" % (username, keep_user[1], username, new_username))
+        renames.append((user_id, new_username))
+
+    self.apply_renames(renames)
+    return len(renames)
+
+
+  def apply_renames(self, renames, batch_size=300):
+    """
+    Sets the usernames of (id, new username) pairs with one UPDATE ... CASE per batch, all in one transaction
+    """
+    qn = connection.ops.quote_name
+    table = qn(User._meta.db_table)
+    id_column = qn(User._meta.pk.column)
+    username_column = qn(User._meta.get_field('username').column)
+    with transaction.atomic():
+      cursor = connection.cursor()
+      for start in range(0, len(renames), batch_size):
+        batch = renames[start:start + batch_size]
+        params = []
+        for user_id, new_username in batch:
+          params += [user_id, new_username]
+        params += [user_id for user_id, new_username in batch]
+        cursor.execute("UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)" % (
+          table, username_column, id_column, " ".join(["WHEN %s THEN %s"] * len(batch)), id_column, ", ".join(["%s"] * len(batch))), params)
+
+
+  def plan_case_changes(self, newcase):
+    """
+    Reads all usernames once and returns ([(id, old username, new username)], {new username: [old usernames]}) for
+    the users whose name changes case. Users whose new name would collide with another user are left out and returned
+    as collisions instead.
+    """
     if newcase == "lowercase":
-      new_username = username.lower()
+      change_case = lambda username: username.lower()
     elif newcase == "uppercase":
-      new_username = username.upper()
+      change_case = lambda username: username.upper()
     else:
-      new_username = username
-
-    if "renamed" not in username and username != new_username:
-      LOG.warn("Changing user case, renaming %s to %s" % (username, new_username))
-      user_mod = User.objects.get(username=username)
-      user_mod.username = new_username
-      user_mod.save()
-
-
-  def log_users_list(self):
-    users_unsorted = []
-    for user in User.objects.filter():
-      users_unsorted.append(user.username)
-
-    users_sorted = sorted(users_unsorted, key=lambda s: s.lower())
-    count = 0
-    while count < len(users_sorted):
-      LOG.warn("%s" % users_sorted[count])
-      count = count + 1
+      return [], {}
+
+    users = list(User.objects.values_list('id', 'username').iterator())
+    targets = {}
+    for user_id, username in users:
+      targets[user_id] = username if "renamed" in username else change_case(username)
+
+    collisions = {}
+    while True:
+      owners = {}
+      for user_id, username in users:
+        owners.setdefault(targets[user_id], []).append((user_id, username))
+      colliding = [(name, owner_list) for name, owner_list in owners.items() if len(owner_list) > 1]
+      if not colliding:
+        break
+      # Colliding users keep their current name, which can in turn collide with another target
+      for name, owner_list in colliding:
+        for user_id, username in owner_list:
+          if targets[user_id] != username:
+            collisions.setdefault(name, []).append(username)
+            targets[user_id] = username
+
+    changes = [(user_id, username, targets[user_id]) for user_id, username in users if targets[user_id] != username]
+    return changes, collisions
+
+
+  def change_users_case(self, newcase):
+    changes, collisions = self.plan_case_changes(newcase)
+    for name, usernames in sorted(collisions.items()):
+      LOG.warn("Not renaming %s, %s is already taken" % (", ".join(sorted(usernames)), name))
+    for user_id, username, new_username in changes:
+      LOG.info("Changing user case, renaming %s to %s" % (username, new_username))
+    self.apply_renames([(user_id, new_username) for user_id, username, new_username in changes])
+    LOG.warn("Changed the case of %s usernames, skipped %s because of collisions" % (len(changes), sum(len(usernames) for usernames in collisions.values())))
 
 
   def handle(self, *args, **options):
     LOG.warn("Deleting duplicate User objects")
 
-    self.users_dict = {}
-    self.username = None
-
-    LOG.warn("users list before renames")
-    self.log_users_list()
-
-
-    for user in User.objects.filter():
-      user_list = [{'username': user.username, 'date_joined': user.date_joined, 'date_joined_readable': user.date_joined.strftime('%Y-%m-%d %H:%M:%S%z')}]
-      self.users_dict[user.username.lower()] = user_list
-      for usercompare in User.objects.filter():
-        if usercompare.id != user.id and usercompare.username.lower() == user.username.lower():
-          self.users_dict[user.username.lower()].append({'username': usercompare.username, 'date_joined': usercompare.date_joined, 'date_joined_readable': usercompare.date_joined.strftime('%Y-%m-%d %H:%M:%S%z')})
-
-    for username in self.users_dict.keys():
-      self.username = username
-      count = 0
-      oldest_user = None
-      oldest_date = None
-      while count < len(self.users_dict[self.username]):
-        current_dict = self.users_dict[self.username]
-        if oldest_user is None:
-          username1 = current_dict[count]['username']
-          date1 = current_dict[count]['date_joined']
-          username2 = current_dict[count + 1]['username']
-          date2 = current_dict[count + 1]['date_joined']
-          if date1 < date2:
-            oldest_user = username1
-            oldest_date = date1
-            oldest_count = count
-            self.rename_user(rename_user=username2, keep_user=oldest_user, count=count + 1)
-          else:
-            oldest_user = username2
-            oldest_date = date2
-            oldest_count = count + 1
-            self.rename_user(rename_user=username1, keep_user=oldest_user, count=count)
-        else:
-          username2 = current_dict[count]['username']
-          date2 = current_dict[count]['date_joined']
-          if username2.lower() == self.username and username2 != oldest_user:
-            if oldest_date < date2:
-              self.rename_user(rename_user=username2, keep_user=oldest_user, count=count)
-            else:
-              self.rename_user(rename_user=oldest_user, keep_user=username2, count=oldest_count)
-              oldest_user = username2
-              oldest_date = date2
-              oldest_count = count
-
-        count = count + 1
+    duplicates = self.find_duplicate_users()
+    LOG.warn("Found %s usernames shared by more than one user" % len(duplicates))
+    renamed = self.rename_duplicate_users(duplicates)
+    LOG.warn("Renamed %s duplicate users" % renamed)
 
     LOG.warn("renaming all users to be %s" % options['renamecase'])
-    for user in User.objects.filter():
-      self.change_user_case(username=user.username, newcase=options['renamecase'])
-
-    LOG.warn("users list after renames")
-    self.log_users_list()
+    self.change_users_case(options['renamecase'])
 
     transaction.commit()
 
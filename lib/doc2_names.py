@@ -0,0 +1,63 @@
+import re
+
+DOC2_NAME_INVALID_CHARS = "[<>/{}\[\]]"
+
+# Same characters as DOC2_NAME_INVALID_CHARS, plus anything outside of ascii
+_INVALID_NAME_CHARS = "<>/{}[]"
+_INVALID_NAME_BYTES = _INVALID_NAME_CHARS + "".join(chr(i) for i in range(0x80, 0x100))
+_INVALID_NAME_RE = re.compile(u"[^\x00-\x7f]|%s" % DOC2_NAME_INVALID_CHARS)
+
+# Conversion sees the same names over and over, keep a memo of sanitized names in two generations: names are
+# looked up in the current one and promoted from the previous one, when the current one is full it becomes the
+# previous one. Recently used names survive a rotation like in an LRU, at the cost of plain dict lookups instead of
+# reordering an OrderedDict on every hit, which made the memo slower than sanitizing.
+_NAME_CACHE = {}
+_OLD_NAME_CACHE = {}
+_NAME_CACHE_SIZE = 10000
+# A miss costs more than sanitizing, when a generation fills up with fewer hits than misses the working set does not
+# fit and the memo is skipped for this many names before trying again
+_NAME_CACHE_BYPASS = _NAME_CACHE_SIZE * 10
+_name_cache_hits = 0
+_name_cache_bypass = 0
+
+
+def _sanitize(fixString):
+  if isinstance(fixString, str):
+    return fixString.translate(None, _INVALID_NAME_BYTES)
+  return _INVALID_NAME_RE.sub(u'', fixString)
+
+
+def clearNameCache():
+  global _NAME_CACHE, _OLD_NAME_CACHE, _name_cache_hits, _name_cache_bypass
+  _NAME_CACHE = {}
+  _OLD_NAME_CACHE = {}
+  _name_cache_hits = 0
+  _name_cache_bypass = 0
+
+
+def removeInvalidChars(fixString):
+  global _NAME_CACHE, _OLD_NAME_CACHE, _name_cache_hits, _name_cache_bypass
+  if _name_cache_bypass:
+    _name_cache_bypass -= 1
+    return _sanitize(fixString)
+
+  # get() instead of catching KeyError, raising on every miss cost more than sanitizing the name
+  try:
+    cleanString = _NAME_CACHE.get(fixString)
+  except TypeError:
+    return _sanitize(fixString)
+  if cleanString is not None:
+    _name_cache_hits += 1
+    return cleanString
+
+  cleanString = _OLD_NAME_CACHE.get(fixString)
+  if cleanString is None:
+    cleanString = _sanitize(fixString)
+  if len(_NAME_CACHE) >= _NAME_CACHE_SIZE:
+    if _name_cache_hits < _NAME_CACHE_SIZE:
+      _name_cache_bypass = _NAME_CACHE_BYPASS
+    _name_cache_hits = 0
+    _OLD_NAME_CACHE = _NAME_CACHE
+    _NAME_CACHE = {}
+  _NAME_CACHE[fixString] = cleanString
+  return cleanString
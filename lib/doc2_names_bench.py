@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark of removeInvalidChars against the previous re.sub implementation, with and without the memo and
+# with a working set of names larger than the memo
+#   python doc2_names_bench.py [count]
+#
+
+import re
+import sys
+import time
+import random
+
+from doc2_names import removeInvalidChars, DOC2_NAME_INVALID_CHARS, _sanitize, clearNameCache, _NAME_CACHE_SIZE
+
+
+def removeInvalidCharsOld(fixString):
+  fixString = re.sub(r'[^\x00-\x7f]',r'', fixString)
+  return re.sub(DOC2_NAME_INVALID_CHARS, '', fixString)
+
+
+def query_names(count, distinct_count=5000):
+  random.seed(0)
+  prefixes = [u"daily_report", u"Sales {Q3}", u"tmp/impala test", u"customer <pii> scan", u"caf\xe9 revenue", u"[adhoc] join", u"etl_load", u"sample_07"]
+  # Conversion mostly sees names repeated from a smaller set, mimic that with a few thousand distinct names
+  distinct = [u"%s %s" % (random.choice(prefixes), i) for i in range(distinct_count)]
+  return [random.choice(distinct) for i in range(count)]
+
+
+def timeit(func, names):
+  start = time.time()
+  for name in names:
+    func(name)
+  return time.time() - start
+
+
+def run(label, count, distinct_count):
+  names = query_names(count, distinct_count)
+
+  for name in set(names):
+    assert removeInvalidChars(name) == removeInvalidCharsOld(name), name
+    assert removeInvalidChars(name.encode('utf-8')) == removeInvalidCharsOld(name.encode('utf-8')), name
+
+  old = timeit(removeInvalidCharsOld, names)
+  sanitize = timeit(_sanitize, names)
+  clearNameCache()
+  new = timeit(removeInvalidChars, names)
+  print("%s: %s names, %s distinct: re.sub: %.2fs unmemoized: %.2fs (%.1fx) removeInvalidChars: %.2fs (%.1fx)" %
+        (label, count, distinct_count, old, sanitize, old / sanitize, new, old / new))
+
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+  run("fits the memo", count, _NAME_CACHE_SIZE // 2)
+  run("larger than the memo", count, _NAME_CACHE_SIZE * 10)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,78 @@
+import logging
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from desktop.models import Document, DocumentPermission, Document2, Document2Permission
+from purge_engine import BatchPurger
+
+LOG = logging.getLogger(__name__)
+
+
+def _m2m(model, name):
+  """
+  Returns (table, column pointing to model) of the through table of a ManyToManyField
+  """
+  field = model._meta.get_field(name)
+  return field.m2m_db_table(), field.m2m_column_name()
+
+
+class Document2Purger(BatchPurger):
+  """
+  BatchPurger for Document2 that deletes the dependent rows itself with DELETE ... WHERE ... IN (subquery)
+  statements, children first, instead of letting the ORM collect every related object in Python. Covers the doc1
+  link (with its tags and permissions), dependencies and Document2Permissions. Meant for history docs, which are
+  never the parent directory of another doc.
+  """
+
+  def __init__(self, queryset, **options):
+    BatchPurger.__init__(self, queryset, **options)
+    # The dependencies statement uses every id twice, stay under the same SQL variable limit
+    self.max_batch_size = max((self.max_batch_size - 1) // 2, 1)
+    self.batch_size = min(self.batch_size, self.max_batch_size)
+    qn = connection.ops.quote_name
+
+    document_table = qn(Document._meta.db_table)
+    document2_table = qn(Document2._meta.db_table)
+    permission_table = qn(DocumentPermission._meta.db_table)
+    permission2_table = qn(Document2Permission._meta.db_table)
+    self.doc2_content_type = ContentType.objects.get_for_model(Document2).id
+
+    permission_doc = qn(DocumentPermission._meta.get_field('doc').column)
+    permission2_doc = qn(Document2Permission._meta.get_field('doc').column)
+
+    # IDS is replaced with one placeholder per id of the batch
+    links = "SELECT id FROM %s WHERE content_type_id = %%s AND object_id IN (IDS)" % document_table
+    permissions = "SELECT id FROM %s WHERE %s IN (%s)" % (permission_table, permission_doc, links)
+    permissions2 = "SELECT id FROM %s WHERE %s IN (IDS)" % (permission2_table, permission2_doc)
+
+    statements = []
+    table, column = _m2m(Document, 'tags')
+    statements.append(("DELETE FROM %s WHERE %s IN (%s)" % (qn(table), qn(column), links), True))
+    for name in ('users', 'groups'):
+      table, column = _m2m(DocumentPermission, name)
+      statements.append(("DELETE FROM %s WHERE %s IN (%s)" % (qn(table), qn(column), permissions), True))
+    statements.append(("DELETE FROM %s WHERE %s IN (%s)" % (permission_table, permission_doc, links), True))
+    statements.append(("DELETE FROM %s WHERE content_type_id = %%s AND object_id IN (IDS)" % document_table, True))
+
+    table, column = _m2m(Document2, 'dependencies')
+    reverse_column = Document2._meta.get_field('dependencies').m2m_reverse_name()
+    statements.append(("DELETE FROM %s WHERE %s IN (IDS) OR %s IN (IDS)" % (qn(table), qn(column), qn(reverse_column)), False))
+    for name in ('users', 'groups'):
+      table, column = _m2m(Document2Permission, name)
+      statements.append(("DELETE FROM %s WHERE %s IN (%s)" % (qn(table), qn(column), permissions2), False))
+    statements.append(("DELETE FROM %s WHERE %s IN (IDS)" % (permission2_table, permission2_doc), False))
+    statements.append(("DELETE FROM %s WHERE id IN (IDS)" % document2_table, False))
+
+    # (sql, whether it starts with the doc1 content type parameter)
+    self.statements = statements
+
+
+  def _delete(self, ids):
+    placeholders = ", ".join(["%s"] * len(ids))
+    with transaction.atomic():
+      cursor = connection.cursor()
+      for sql, with_content_type in self.statements:
+        params = list(ids) * sql.count("IDS")
+        sql = sql.replace("IDS", placeholders)
+        if with_content_type:
+          params = [self.doc2_content_type] + params
+        cursor.execute(sql, params)
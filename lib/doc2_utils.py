@@ -2,17 +2,13 @@ import json
 import re
 import logging
 import difflib
+import hashlib
 
 from desktop.models import Document2
-#DOC2_NAME_INVALID_CHARS = "[<>/{}[\]~`u'\xe9'u'\xfa'u'\xf3'u'\xf1'u'\xed']"
-DOC2_NAME_INVALID_CHARS = "[<>/{}\[\]]"
+from doc2_names import DOC2_NAME_INVALID_CHARS, removeInvalidChars
 
 LOG = logging.getLogger(__name__)
 
-def removeInvalidChars(fixString):
-  fixString = re.sub(r'[^\x00-\x7f]',r'', fixString)
-  return re.sub(DOC2_NAME_INVALID_CHARS, '', fixString)
-
 
 def findMatchingQuery(user, id, name, query, include_history=False, all=False, values=False):
 #Returns list of matching queries.  If all = False
@@ -46,6 +42,46 @@ def findMatchingQuery(user, id, name, query, include_history=False, all=False, v
     return matchvalues
 
 
+class QueryFingerprintIndex(object):
+  """
+  Per-user index of saved queries keyed by (normalized name, statement hash), built with one
+  query so duplicate checks during a conversion run are a dict lookup instead of findMatchingQuery
+  """
+
+  def __init__(self, user, include_history=False):
+    self.user = user
+    self.index = {}
+
+    documents = Document2.objects.filter(owner=user, type__in=['query-hive', 'query-impala'])
+    if not include_history:
+      documents = documents.filter(is_history=False)
+
+    for id, name, data in documents.values_list('id', 'name', 'data').iterator():
+      try:
+        matchdata = json.loads(data)
+      except ValueError:
+        continue
+      if matchdata.get('snippets'):
+        self.add(id, name, matchdata['snippets'][0].get('statement_raw'))
+
+
+  def _key(self, name, query):
+    if isinstance(query, unicode):
+      query = query.encode('utf-8')
+    return (removeInvalidChars(name), hashlib.md5(query or '').hexdigest())
+
+
+  def add(self, id, name, query):
+    self.index.setdefault(self._key(name, query), []).append(id)
+
+
+  def find(self, name, query):
+    """
+    Returns the ids of the indexed docs with the same name and statement
+    """
+    return self.index.get(self._key(name, query), [])
+
+
 def getSavedQueries(user, name=None, include_history=False):
 #mimic api call to get saved queries
   perms = 'both'
@@ -79,3 +115,33 @@ def getSavedQueries(user, name=None, include_history=False):
   return documents
 
 
+
+def backfillIsTrashed(owner=None, chunk_size=900):
+#Set-based replacement for saving every Document2 with is_trashed=None.
+#Docs under a home /.Trash directory get is_trashed=True and the rest False,
+#update() leaves last_modified untouched.  Returns the number of docs updated.
+  documents = Document2.objects.all()
+  if owner is not None:
+    documents = documents.filter(owner=owner)
+
+  #Trash directories are the .Trash children of home directories (no parent)
+  trash_dirs = list(documents.filter(type='directory', name='.Trash', parent_directory__isnull=False, parent_directory__parent_directory__isnull=True).values_list('id', flat=True))
+
+  #Walk down the trash trees one level per query
+  trashed = 0
+  frontier = trash_dirs
+  while frontier:
+    children = []
+    for start in range(0, len(frontier), chunk_size):
+      parent_ids = frontier[start:start + chunk_size]
+      trashed += Document2.objects.filter(parent_directory__in=parent_ids, is_trashed=None).update(is_trashed=True)
+      children += Document2.objects.filter(parent_directory__in=parent_ids, type='directory').values_list('id', flat=True)
+    frontier = children
+
+  #Home directories (empty path) and the trash directories themselves were skipped before and stay None
+  restored = documents.filter(is_trashed=None) \
+    .exclude(name='', parent_directory__isnull=True) \
+    .exclude(type='directory', name='.Trash', parent_directory__isnull=False, parent_directory__parent_directory__isnull=True) \
+    .update(is_trashed=False)
+
+  return trashed + restored
@@ -19,12 +19,47 @@ class DocumentCounts(object):
     LOG.info("Sai")
     self.user = user
     self.differ = differ
-    self.home_dir = Document2.objects.create_user_directories(self.user)
-    sys.stdout = open('counts.txt', 'a')
-    
+    self._home_dir = None
+
+
+  @property
+  def home_dir(self):
+    # Created on first use so counting stays read only
+    if self._home_dir is None:
+      self._home_dir = Document2.objects.create_user_directories(self.user)
+    return self._home_dir
+
+
+  def getPendingCounts(self):
+    """
+    Returns the number of unconverted docs of each kind the converter will process, using COUNT queries only
+    """
+    counts = {'saved_query': 0, 'query_history': 0, 'workflow': 0, 'pigscript': 0}
+    try:
+      from beeswax.models import SavedQuery, HQL, IMPALA, RDBMS
+      counts['saved_query'] = self._get_unconverted_docs(SavedQuery).filter(extra__in=[HQL, IMPALA, RDBMS]).count()
+      counts['query_history'] = self._get_unconverted_docs(SavedQuery, with_history=True).filter(extra__in=[HQL, IMPALA, RDBMS]).count()
+    except ImportError:
+      LOG.info('Cannot count Saved Query documents: beeswax app is not installed')
+
+    try:
+      from oozie.models import Workflow
+      counts['workflow'] = self._get_unconverted_docs(Workflow).count()
+    except ImportError:
+      LOG.info('Cannot count Job Designer documents: oozie app is not installed')
+
+    try:
+      from pig.models import PigScript
+      counts['pigscript'] = self._get_unconverted_docs(PigScript).count()
+    except ImportError:
+      LOG.info('Cannot count Pig documents: pig app is not installed')
+
+    return counts
+
 
   def printCounts(self):
     LOG.info("HI")
+    sys.stdout = open('counts.txt', 'a')
     # Convert SavedQuery documents
     try:
       from beeswax.models import SavedQuery, HQL, IMPALA, RDBMS
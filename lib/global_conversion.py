@@ -0,0 +1,146 @@
+import time
+import logging
+from collections import OrderedDict
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import FieldError
+from desktop.models import Document, DocumentTag
+from doc2_utils import QueryFingerprintIndex, backfillIsTrashed
+from hue_converters import DocumentConverterHueScripts, iter_doc_chunks, TRANSIENT_DB_ERRORS
+from conversion_checkpoint import FAILED
+from conversion_stats import ConversionStats
+
+LOG = logging.getLogger(__name__)
+
+
+class GlobalDocumentConverter(object):
+  """
+  Converts the unconverted SavedQuery docs of all users in id order instead of user by user. Reserved tags of every
+  user are read with one query and each chunk of docs is grouped by owner before being handed to that owner's
+  converter, so users with only a few docs do not pay the per user lookups of DocumentConverterHueScripts.
+  """
+
+  DOC_CHUNK_SIZE = 1000
+
+  def __init__(self, allowdupes=False, checkpoint=None, history_batch_size=None, stats=None, max_converters=100):
+    self.allowdupes = allowdupes
+    self.checkpoint = checkpoint
+    self.history_batch_size = history_batch_size
+    self.stats = stats if stats is not None else ConversionStats()
+    self.max_converters = max_converters
+    self.converters = OrderedDict()
+    self.reserved_tags = {}
+    self.failed_owners = set()
+    self.owners_with_failed_docs = set()
+    self.imported = 0
+
+
+  def _get_reserved_tags(self):
+    """
+    Returns {tag name: {owner id: DocumentTag}} for the reserved tags of all users
+    """
+    reserved = {DocumentTag.TRASH: {}, DocumentTag.EXAMPLE: {}, DocumentTag.HISTORY: {}, DocumentTag.IMPORTED2: {}}
+    for tag in DocumentTag.objects.filter(tag__in=reserved.keys()):
+      reserved[tag.tag][tag.owner_id] = tag
+    return reserved
+
+
+  def _get_converter(self, owner_id):
+    """
+    Returns the converter of an owner, keeping the most recently used ones. Evicted converters write their pending
+    history first.
+    """
+    if owner_id in self.converters:
+      converter = self.converters.pop(owner_id)
+    else:
+      user = User.objects.get(id=owner_id)
+      converter = DocumentConverterHueScripts(user, allowdupes=self.allowdupes, checkpoint=self.checkpoint,
+                                              history_batch_size=self.history_batch_size, stats=self.stats,
+                                              imported_tag=self.reserved_tags.get(DocumentTag.IMPORTED2, {}).get(owner_id))
+      if not self.allowdupes:
+        with self.stats.stage('dedupe'):
+          converter.query_index = QueryFingerprintIndex(user, include_history=False)
+      if len(self.converters) >= self.max_converters:
+        evicted_id, evicted = self.converters.popitem(last=False)
+        evicted.flush_history()
+        self.imported += evicted.imported_count
+        if evicted.failed:
+          self.owners_with_failed_docs.add(evicted_id)
+    self.converters[owner_id] = converter
+    return converter
+
+
+  def _convert_stage(self, stage, docs, convert):
+    with self.stats.stage(stage):
+      for chunk in iter_doc_chunks(docs, self.DOC_CHUNK_SIZE):
+        by_owner = OrderedDict()
+        for doc in chunk:
+          by_owner.setdefault(doc.owner_id, []).append(doc)
+
+        for owner_id, owner_docs in by_owner.items():
+          if owner_id in self.failed_owners:
+            continue
+          try:
+            converter = self._get_converter(owner_id)
+          except TRANSIENT_DB_ERRORS:
+            # Not the owner's fault, stop so the run can be restarted with the same checkpoint
+            raise
+          except Exception, e:
+            LOG.warn("Conversions failed for user id: %s: %s" % (owner_id, e))
+            self.failed_owners.add(owner_id)
+            continue
+          for doc in owner_docs:
+            if converter._is_done(stage, doc):
+              continue
+            with self.stats.document(stage):
+              try:
+                convert(converter, doc)
+              except TRANSIENT_DB_ERRORS:
+                raise
+              except Exception, e:
+                LOG.exception("Failed to convert doc id: %s of user id: %s" % (doc.id, owner_id))
+                converter._record(stage, doc, FAILED)
+                self.owners_with_failed_docs.add(owner_id)
+
+      for converter in self.converters.values():
+        converter.flush_history()
+
+
+  def convert(self):
+    try:
+      from beeswax.models import SavedQuery, HQL, IMPALA, RDBMS
+    except ImportError:
+      LOG.info('Cannot convert Saved Query documents: beeswax app is not installed')
+      return
+
+    start = time.time()
+    self.reserved_tags = self._get_reserved_tags()
+
+    trash_and_examples = [tag.id for name in (DocumentTag.TRASH, DocumentTag.EXAMPLE) for tag in self.reserved_tags[name].values()]
+    history = [tag.id for tag in self.reserved_tags[DocumentTag.HISTORY].values()]
+
+    docs = Document.objects.filter(content_type=ContentType.objects.get_for_model(SavedQuery), extra__in=[HQL, IMPALA, RDBMS])\
+                           .exclude(tags__in=trash_and_examples)
+
+    LOG.info("Converting saved queries of all users")
+    self._convert_stage('saved_query', docs.exclude(tags__in=history), lambda converter, doc: converter._convert_saved_query(doc))
+
+    LOG.info("Converting query history of all users")
+    self._convert_stage('query_history', docs, lambda converter, doc: converter._convert_history(doc))
+
+    self.imported += sum(converter.imported_count for converter in self.converters.values())
+    self.owners_with_failed_docs.update(owner_id for owner_id, converter in self.converters.items() if converter.failed)
+    self.converters.clear()
+    LOG.info('Successfully imported %d documents' % self.imported)
+
+    try:
+      with self.stats.stage('is_trashed'):
+        backfillIsTrashed()
+    except FieldError, e:
+      LOG.info("Skipping is_trashed as does not exist in this version")
+
+    if self.failed_owners:
+      LOG.warn("Conversions failed for user ids: %s" % ",".join(str(owner_id) for owner_id in sorted(self.failed_owners)))
+    if self.owners_with_failed_docs:
+      LOG.warn("Some docs failed to convert for user ids: %s" % ",".join(str(owner_id) for owner_id in sorted(self.owners_with_failed_docs)))
+    LOG.info("Finished converting all users: elapsed time (minutes): %.2f" % ((time.time() - start) / 60))
@@ -3,23 +3,88 @@ import logging
 import time
 import re
 
-from django.db import transaction
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+from django.db.utils import OperationalError, InterfaceError
+from django.contrib.contenttypes.models import ContentType
+from django.utils.translation import ugettext as _
 
 from desktop.lib.exceptions_renderable import PopupException
 from django.core.exceptions import FieldError
 from desktop.models import Document, DocumentPermission, DocumentTag, Document2, Directory, Document2Permission, FilesystemException
 from notebook.models import import_saved_beeswax_query
-from doc2_utils import findMatchingQuery, removeInvalidChars
+try:
+  from notebook.api import DEFAULT_HISTORY_NAME
+except ImportError:
+  # Older Hue versions do not define it, same value as notebook.api
+  DEFAULT_HISTORY_NAME = ''
+from doc2_utils import QueryFingerprintIndex, removeInvalidChars, backfillIsTrashed
+from conversion_checkpoint import CONVERTED, DUPLICATE, FAILED
+from conversion_stats import ConversionStats
 
 LOG = logging.getLogger(__name__)
 
+# Errors worth retrying a user for, such as lost connections, lock timeouts or deadlocks. The per doc handlers
+# re-raise them so the whole user fails and is retried instead of every remaining doc being journaled as failed.
+TRANSIENT_DB_ERRORS = (OperationalError, InterfaceError)
+
+# SavedQuery design parsed once per doc and shared by matching, conversion and history
+ParsedQuery = namedtuple('ParsedQuery', ['name', 'type', 'statement', 'description', 'data'])
+
+
+@contextmanager
+def _keep_last_modified(model):
+  """
+  Disables auto_now on model.last_modified so bulk inserts keep the values set on the instances
+  """
+  field = model._meta.get_field('last_modified')
+  auto_now = field.auto_now
+  field.auto_now = False
+  try:
+    yield
+  finally:
+    field.auto_now = auto_now
+
+
+def iter_doc_chunks(docs, chunk_size, newest_first=False):
+  """
+  Yields lists of chunk_size docs in id order with their content objects, paging with id > last id. With
+  newest_first the docs come in (last_modified, id) descending order instead, paging on both columns.
+  """
+  docs = docs.select_related('content_type').prefetch_related('content_object')
+  docs = docs.order_by('-last_modified', '-id') if newest_first else docs.order_by('id')
+  last = None
+  while True:
+    if last is None:
+      page = docs
+    elif newest_first:
+      page = docs.filter(Q(last_modified__lt=last.last_modified) | Q(last_modified=last.last_modified, id__lt=last.id))
+    else:
+      page = docs.filter(id__gt=last.id)
+    chunk = list(page[:chunk_size])
+    if not chunk:
+      break
+    yield chunk
+    last = chunk[-1]
+
+
 class DocumentConverterHueScripts(object):
   """
   Given a user, converts any existing Document objects to Document2 objects
   """
 
-  def __init__(self, user, allowdupes=False, startqueryname=None, startuser=None, processdocs=None):
+  DOC_CHUNK_SIZE = 1000
+  # Saved queries parsed by the saved query loop kept for the history loop, the oldest are dropped past this
+  PARSED_QUERY_CACHE_SIZE = 1000
+
+  def __init__(self, user, allowdupes=False, startqueryname=None, startuser=None, processdocs=None, checkpoint=None, history_batch_size=None, stats=None, imported_tag=None):
     self.user = user
+    self.stats = stats if stats is not None else ConversionStats()
+    self.checkpoint = checkpoint
+    self.history_batch_size = history_batch_size
     self.allowdupes = allowdupes
     self.startqueryname = startqueryname
     self.startuser = startuser
@@ -33,48 +98,45 @@ class DocumentConverterHueScripts(object):
     except FilesystemException, e:
       LOG.warn("User: %s failed: Exception: %s" % (self.user, e))
       raise
-    self.imported_tag = DocumentTag.objects.get_imported2_tag(user=self.user)
-    self.imported_docs = []
+    self.imported_tag = imported_tag if imported_tag is not None else DocumentTag.objects.get_imported2_tag(user=self.user)
+    # Only the number of converted docs is kept, holding on to them would keep every data blob of the user in memory
+    self.imported_count = 0
+    self.failed_docs = []
+    self.failed = 0
+    self.query_index = None
+    self.project_tags = None
+    self.project_directories = {}
+    self.doc_permissions = None
+    self.parsed_queries = OrderedDict()
+    self.pending_history = []
+
+
+  def _is_done(self, stage, doc):
+    return self.checkpoint is not None and self.checkpoint.is_done(self.user.id, stage, doc.id)
+
+
+  def _record(self, stage, doc, outcome):
+    if outcome == FAILED:
+      self.failed += 1
+    if self.checkpoint is not None:
+      self.checkpoint.record(self.user.id, stage, doc.id, outcome)
 
 
   def convertfailed(self):
     # Convert SavedQuery documents
     try:
       from beeswax.models import SavedQuery, HQL, IMPALA, RDBMS
-  
-      docs = self._get_unconverted_docs(SavedQuery).filter(extra__in=[HQL, IMPALA, RDBMS])
-      for doc in docs:
-        if doc.content_object:
-          id_temp = doc.to_dict()
-          id = id_temp['id']
-          notebook = import_saved_beeswax_query(doc.content_object)
-          data = notebook.get_data()
-          name = data['name']
-          query = data['snippets'][0]['statement_raw']
-          if re.match(self.startqueryname, name) and not self.startuser:
-            self.processdocs = True
-          if self.processdocs:
-            matchdocs = findMatchingQuery(user=self.user, id=id, name=name, query=query, include_history=False)
-            if not matchdocs or self.allowdupes:
-              try:
-                if doc.is_historic():
-                  data['isSaved'] = False
-
-                doc2 = self._create_doc2(
-                    document=doc,
-                    doctype=data['type'],
-                    name=data['name'],
-                    description=data['description'],
-                    data=notebook.get_json()
-                )
-
-                if doc.is_historic():
-                  doc2.is_history = False
 
-                self.imported_docs.append(doc2)
-              
-              except:
-                pass
+      with self.stats.stage('saved_query'):
+        docs = self._get_unconverted_docs(SavedQuery).filter(extra__in=[HQL, IMPALA, RDBMS])
+        if not self.allowdupes:
+          with self.stats.stage('dedupe'):
+            self.query_index = QueryFingerprintIndex(self.user, include_history=False)
+        for doc in self._iter_docs(docs):
+          if self._is_done('saved_query', doc):
+            continue
+          with self.stats.document('saved_query'):
+            self._convert_saved_query(doc)
 
     except ImportError:
       LOG.info('Cannot convert Saved Query documents: beeswax app is not installed')
@@ -84,55 +146,20 @@ class DocumentConverterHueScripts(object):
     try:
       from beeswax.models import SavedQuery, HQL, IMPALA, RDBMS
 
-      docs = self._get_unconverted_docs(SavedQuery, with_history=True).filter(extra__in=[HQL, IMPALA, RDBMS]).order_by('-last_modified')
-
-      for doc in docs:
-  	if not doc.content_object:
-          LOG.error("Content object is missing")
-        elif doc.content_object:
-          id_temp = doc.to_dict()
-          id = id_temp['id']
-          notebook = import_saved_beeswax_query(doc.content_object)
-          data = notebook.get_data()
-          name = data['name']
-          query = data['snippets'][0]['statement_raw']
-          if re.match(self.startqueryname, name) and not self.startuser:
-            self.processdocs = True
-          if self.processdocs:
-            try:
-              data['isSaved'] = False
-              data['snippets'][0]['lastExecuted'] = time.mktime(doc.last_modified.timetuple()) * 1000
-
-              doc2 = self._historify(data, self.user)
-              doc2.last_modified = doc.last_modified
-
-              # save() updates the last_modified to current time. Resetting it using update()
-              doc2.save()
-              Document2.objects.filter(id=doc2.id).update(last_modified=doc.last_modified)
- 
-              self.imported_docs.append(doc2)
-  
-                # Tag for not re-importing
-              Document.objects.link(
-                doc2,
-                owner=doc2.owner,
-                name=doc2.name,
-                description=doc2.description,
-                extra=doc.extra
-              )
-  
-              try:
-                doc.add_tag(self.imported_tag)
-              except IntegrityError, e:
-                LOG.exception("Failed to add imported_tag to doc %s with error %s" % (doc2.name, e))
-                pass
-
-              doc.save()
-
-            except:
-              LOG.exception("Doc name: %s" % (doc.name))
-              pass  
-         
+      with self.stats.stage('query_history'):
+        docs = self._get_unconverted_docs(SavedQuery, with_history=True).filter(extra__in=[HQL, IMPALA, RDBMS])
+
+        # Newest first like before chunking, --startqueryname resumes at the first match in this order
+        for doc in self._iter_docs(docs, newest_first=True):
+          if self._is_done('query_history', doc):
+            continue
+          with self.stats.document('query_history'):
+            self._convert_history(doc)
+
+        self.flush_history()
+        # Records the history loop skipped are not needed anymore
+        self.parsed_queries.clear()
+
     except ImportError, e:
       LOG.info('Cannot convert Saved Query documents: beeswax app is not installed')
       pass
@@ -142,22 +169,30 @@ class DocumentConverterHueScripts(object):
       from oozie.models import Workflow
 
       # TODO: Change this logic to actually embed the workflow data in Doc2 instead of linking to old job design
-      docs = self._get_unconverted_docs(Workflow)
-      for doc in docs:
-        try:
-          if doc.content_object:
-            data = doc.content_object.data_dict
-            data.update({'content_type': doc.content_type.model, 'object_id': doc.object_id})
-            doc2 = self._create_doc2(
-                document=doc,
-                doctype='link-workflow',
-                description=doc.description,
-                data=json.dumps(data)
-            )
-            self.imported_docs.append(doc2)
-        except Exception, e:
-          self.failed_docs.append(doc)
-          LOG.exception('Failed to import Job Designer document id: %d' % doc.id)
+      with self.stats.stage('workflow'):
+        docs = self._get_unconverted_docs(Workflow)
+        for doc in self._iter_docs(docs):
+          if self._is_done('workflow', doc):
+            continue
+          with self.stats.document('workflow'):
+            try:
+              if doc.content_object:
+                data = doc.content_object.data_dict
+                data.update({'content_type': doc.content_type.model, 'object_id': doc.object_id})
+                doc2 = self._create_doc2(
+                    document=doc,
+                    doctype='link-workflow',
+                    description=doc.description,
+                    data=json.dumps(data)
+                )
+                self.imported_count += 1
+                self._record('workflow', doc, CONVERTED)
+            except TRANSIENT_DB_ERRORS:
+              raise
+            except Exception, e:
+              self.failed_docs.append(doc)
+              self._record('workflow', doc, FAILED)
+              LOG.exception('Failed to import Job Designer document id: %d' % doc.id)
     except ImportError, e:
       LOG.warn('Cannot convert Job Designer documents: oozie app is not installed')
 
@@ -167,49 +202,131 @@ class DocumentConverterHueScripts(object):
       from pig.models import PigScript
 
       # TODO: Change this logic to actually embed the pig data in Doc2 instead of linking to old pig script
-      docs = self._get_unconverted_docs(PigScript)
-      for doc in docs:
-        try:
-          if doc.content_object:
-            data = doc.content_object.dict
-            data.update({'content_type': doc.content_type.model, 'object_id': doc.object_id})
-            doc2 = self._create_doc2(
-                document=doc,
-                doctype='link-pigscript',
-                description=doc.description,
-                data=json.dumps(data)
-            )
-            self.imported_docs.append(doc2)
-        except Exception, e:
-          self.failed_docs.append(doc)
-          LOG.exception('Failed to import Pig document id: %d' % doc.id)
+      with self.stats.stage('pigscript'):
+        docs = self._get_unconverted_docs(PigScript)
+        for doc in self._iter_docs(docs):
+          if self._is_done('pigscript', doc):
+            continue
+          with self.stats.document('pigscript'):
+            try:
+              if doc.content_object:
+                data = doc.content_object.dict
+                data.update({'content_type': doc.content_type.model, 'object_id': doc.object_id})
+                doc2 = self._create_doc2(
+                    document=doc,
+                    doctype='link-pigscript',
+                    description=doc.description,
+                    data=json.dumps(data)
+                )
+                self.imported_count += 1
+                self._record('pigscript', doc, CONVERTED)
+            except TRANSIENT_DB_ERRORS:
+              raise
+            except Exception, e:
+              self.failed_docs.append(doc)
+              self._record('pigscript', doc, FAILED)
+              LOG.exception('Failed to import Pig document id: %d' % doc.id)
     except ImportError, e:
       LOG.warn('Cannot convert Pig documents: pig app is not installed')
 
     # Add converted docs to root directory
-    if self.imported_docs:
-      LOG.info('Successfully imported %d documents' % len(self.imported_docs))
+    if self.imported_count:
+      LOG.info('Successfully imported %d documents' % self.imported_count)
 
     # Set is_trashed field for old documents with is_trashed=None
     try:
-      docs = Document2.objects.filter(owner=self.user, is_trashed=None)
-      for doc in docs:
-        try:
-          if doc.path and doc.path != '/.Trash':
-            doc_last_modified = doc.last_modified
-            doc.is_trashed = doc.path.startswith('/.Trash')
-            doc.save()
-
-            # save() updates the last_modified to current time. Resetting it using update()
-            Document2.objects.filter(id=doc.id).update(last_modified=doc_last_modified)
-        except Exception, e:
-          LOG.exception("Failed to set is_trashed field with exception: %s" % e)
+      with self.stats.stage('is_trashed'):
+        backfillIsTrashed(owner=self.user)
     except FieldError, e:
       LOG.info("Skipping is_trashed as does not exist in this version") 
+    except TRANSIENT_DB_ERRORS:
+      raise
+    except Exception, e:
+      LOG.exception("Failed to set is_trashed field with exception: %s" % e)
 
     return self.processdocs
 
 
+  def _parse_saved_query(self, doc):
+    """
+    Imports the SavedQuery design of a doc as a notebook and parses its data once
+    """
+    data = import_saved_beeswax_query(doc.content_object).get_data()
+    return ParsedQuery(
+      name=data['name'],
+      type=data['type'],
+      statement=data['snippets'][0]['statement_raw'],
+      description=data['description'],
+      data=data
+    )
+
+
+  def _convert_history(self, doc):
+    if not doc.content_object:
+      LOG.error("Content object is missing")
+    elif doc.content_object:
+      # Saved queries parsed by the saved query loop are reused once and dropped
+      parsed = self.parsed_queries.pop(doc.id, None) or self._parse_saved_query(doc)
+      data = parsed.data
+      if self.startqueryname and re.match(self.startqueryname, parsed.name) and not self.startuser:
+        self.processdocs = True
+      if self.processdocs:
+        data['isSaved'] = False
+        data['snippets'][0]['lastExecuted'] = time.mktime(doc.last_modified.timetuple()) * 1000
+        if self.history_batch_size:
+          self.pending_history.append((doc, data))
+          if len(self.pending_history) >= self.history_batch_size:
+            self.flush_history()
+        else:
+          self._convert_history_doc(doc, data)
+
+
+  def flush_history(self):
+    """
+    Writes the history docs still waiting for a bulk insert
+    """
+    pending_history = self.pending_history
+    self.pending_history = []
+    self._bulk_convert_history(pending_history)
+
+
+  def _convert_saved_query(self, doc):
+    if doc.content_object:
+      parsed = self._parse_saved_query(doc)
+      self.parsed_queries[doc.id] = parsed
+      if len(self.parsed_queries) > self.PARSED_QUERY_CACHE_SIZE:
+        self.parsed_queries.popitem(last=False)
+      if self.startqueryname and re.match(self.startqueryname, parsed.name) and not self.startuser:
+        self.processdocs = True
+      if self.processdocs:
+        with self.stats.stage('dedupe'):
+          matchdocs = self.query_index.find(parsed.name, parsed.statement) if self.query_index is not None else []
+        if not matchdocs or self.allowdupes:
+          try:
+            doc2 = self._create_doc2(
+                document=doc,
+                doctype=parsed.type,
+                name=parsed.name,
+                description=parsed.description,
+                data=json.dumps(parsed.data)
+            )
+
+            if doc.is_historic():
+              doc2.is_history = False
+
+            if self.query_index is not None:
+              self.query_index.add(doc2.id, doc2.name, parsed.statement)
+            self.imported_count += 1
+            self._record('saved_query', doc, CONVERTED)
+
+          except TRANSIENT_DB_ERRORS:
+            raise
+          except:
+            self._record('saved_query', doc, FAILED)
+        else:
+          self._record('saved_query', doc, DUPLICATE)
+
+
   def _get_unconverted_docs(self, content_type, with_history=False):
     docs = Document.objects.get_docs(self.user, content_type).filter(owner=self.user)
 
@@ -225,38 +342,115 @@ class DocumentConverterHueScripts(object):
     return docs.exclude(tags__in=tags)
 
 
+  def _iter_docs(self, docs, newest_first=False):
+    """
+    Iterates over docs in id order, or newest first, reading DOC_CHUNK_SIZE docs and their content objects at a time,
+        so memory stays flat however many docs the user has.
+    """
+    for chunk in iter_doc_chunks(docs, self.DOC_CHUNK_SIZE, newest_first=newest_first):
+      for doc in chunk:
+        yield doc
+
+
   def _get_parent_directory(self, document):
     """
     Returns the parent directory object that should be used for a given document. If the document is tagged with a
         project name (non-RESERVED DocumentTag), a Directory object with the first project tag found is returned.
         Otherwise, the owner's home directory is returned.
     """
-    parent_dir = self.home_dir
-    project_tags = document.tags.exclude(tag__in=DocumentTag.RESERVED)
-    if project_tags.exists():
-      first_tag = project_tags[0]
-      parent_dir, created = Directory.objects.get_or_create(
+    if self.project_tags is None:
+      self.project_tags = self._get_project_tags()
+
+    tag = self.project_tags.get(document.id)
+    if tag is None:
+      return self.home_dir
+
+    if tag not in self.project_directories:
+      self.project_directories[tag], created = Directory.objects.get_or_create(
           owner=self.user,
-          name=first_tag.tag,
+          name=tag,
           parent_directory=self.home_dir
       )
-    return parent_dir
+    return self.project_directories[tag]
+
+
+  def _get_project_tags(self):
+    """
+    Returns a dict of document id to the first project tag of each of the user's documents, read with one query
+    """
+    project_tags = {}
+    tagged = Document.tags.through.objects \
+        .filter(document__owner=self.user) \
+        .exclude(documenttag__tag__in=DocumentTag.RESERVED) \
+        .order_by('id') \
+        .values_list('document_id', 'documenttag__tag')
+    for document_id, tag in tagged.iterator():
+      project_tags.setdefault(document_id, tag)
+    return project_tags
 
 
   def _sync_permissions(self, document, document2):
     """
     Syncs (creates) Document2Permissions based on the DocumentPermissions found for a given document.
     """
-    doc_permissions = DocumentPermission.objects.filter(doc=document)
-    for perm in doc_permissions:
-      try:
-        doc2_permission, created = Document2Permission.objects.get_or_create(doc=document2, perms=perm.perms)
-        if perm.users:
-          doc2_permission.users.add(*perm.users.all())
-        if perm.groups:
-          doc2_permission.groups.add(*perm.groups.all())
-      except:
-        pass
+    with self.stats.stage('permissions'):
+      self._bulk_sync_permissions(document, document2)
+
+
+  def _bulk_sync_permissions(self, document, document2):
+    if self.doc_permissions is None:
+      self.doc_permissions = self._get_doc_permissions()
+
+    doc_permissions = self.doc_permissions.get(document.id)
+    if not doc_permissions:
+      return
+
+    try:
+      # document2 was just created so it has no permissions yet, create them all at once
+      Document2Permission.objects.bulk_create([Document2Permission(doc=document2, perms=perms) for perms in doc_permissions])
+      doc2_permission_ids = dict(Document2Permission.objects.filter(doc=document2).values_list('perms', 'id'))
+
+      UserPermissions = Document2Permission.users.through
+      GroupPermissions = Document2Permission.groups.through
+      user_permissions = []
+      group_permissions = []
+      for perms, (user_ids, group_ids) in doc_permissions.items():
+        doc2_permission_id = doc2_permission_ids[perms]
+        user_permissions += [UserPermissions(document2permission_id=doc2_permission_id, user_id=user_id) for user_id in user_ids]
+        group_permissions += [GroupPermissions(document2permission_id=doc2_permission_id, group_id=group_id) for group_id in group_ids]
+      if user_permissions:
+        UserPermissions.objects.bulk_create(user_permissions)
+      if group_permissions:
+        GroupPermissions.objects.bulk_create(group_permissions)
+    except TRANSIENT_DB_ERRORS:
+      raise
+    except:
+      LOG.exception("Failed to sync permissions of doc %s" % document.id)
+
+
+  def _get_doc_permissions(self):
+    """
+    Returns {document id: {perms: (user ids, group ids)}} for all of the user's documents, read with three queries
+    """
+    doc_permissions = {}
+    permissions = {}
+    for id, doc_id, perms in DocumentPermission.objects.filter(doc__owner=self.user).values_list('id', 'doc_id', 'perms').iterator():
+      # Several DocumentPermission rows with the same perms are merged like get_or_create did
+      permissions[id] = doc_permissions.setdefault(doc_id, {}).setdefault(perms, (set(), set()))
+
+    user_permissions = DocumentPermission.users.through.objects \
+        .filter(documentpermission__doc__owner=self.user) \
+        .values_list('documentpermission_id', 'user_id')
+    for permission_id, user_id in user_permissions.iterator():
+      permissions[permission_id][0].add(user_id)
+
+    group_permissions = DocumentPermission.groups.through.objects \
+        .filter(documentpermission__doc__owner=self.user) \
+        .values_list('documentpermission_id', 'group_id')
+    for permission_id, group_id in group_permissions.iterator():
+      permissions[permission_id][1].add(group_id)
+
+    return doc_permissions
 
 
   def _create_doc2(self, document, doctype, name=None, description=None, data=None):
@@ -290,6 +484,8 @@ class DocumentConverterHueScripts(object):
         document.add_tag(self.imported_tag)
         document.save()
         return document2
+    except TRANSIENT_DB_ERRORS:
+      raise
     except Exception, e:
       raise PopupException(_("Failed to convert Document object: %s") % e)
 
@@ -337,6 +533,138 @@ class DocumentConverterHueScripts(object):
     return history_doc
 
 
+  def _convert_history_doc(self, doc, data):
+    try:
+      # All or nothing, so a user retried after a lost connection does not create the history doc twice
+      with transaction.atomic():
+        doc2 = self._historify(data, self.user)
+        doc2.last_modified = doc.last_modified
+
+        # save() updates the last_modified to current time. Resetting it using update()
+        doc2.save()
+        Document2.objects.filter(id=doc2.id).update(last_modified=doc.last_modified)
+
+        # Tag for not re-importing
+        Document.objects.link(
+          doc2,
+          owner=doc2.owner,
+          name=doc2.name,
+          description=doc2.description,
+          extra=doc.extra
+        )
+
+        try:
+          # Savepoint so a duplicate tag does not break the enclosing transaction
+          with transaction.atomic():
+            doc.add_tag(self.imported_tag)
+        except IntegrityError, e:
+          LOG.exception("Failed to add imported_tag to doc %s with error %s" % (doc2.name, e))
+          pass
+
+        doc.save()
+
+      self.imported_count += 1
+      self._record('query_history', doc, CONVERTED)
+
+    except TRANSIENT_DB_ERRORS:
+      raise
+    except:
+      LOG.exception("Doc name: %s" % (doc.name))
+      self._record('query_history', doc, FAILED)
+
+
+  def _build_history_doc(self, notebook, document):
+    """
+    Builds the Document2 _historify would create, unsaved and with last_modified already set. bulk_create skips
+        Document2.save(), so the home directory that save() would assign as parent is set here.
+    """
+    query_type = notebook['type']
+    name = notebook['name'] if (notebook['name'] and notebook['name'].strip() != '') else DEFAULT_HISTORY_NAME
+    name = removeInvalidChars(name)
+
+    try:
+      history_doc = Document2(
+        name=name,
+        type=query_type,
+        owner=self.user,
+        is_history=True,
+        is_managed=notebook.get('isManaged') == True,
+        parent_directory=self.home_dir,
+        last_modified=document.last_modified
+      )
+    except TypeError:
+      history_doc = Document2(
+        name=name,
+        type=query_type,
+        owner=self.user,
+        is_history=True,
+        parent_directory=self.home_dir,
+        last_modified=document.last_modified
+      )
+
+    notebook['uuid'] = history_doc.uuid
+    history_doc.data = json.dumps(notebook)
+    history_doc.search = self._get_statement(notebook)
+    return history_doc
+
+
+  def _bulk_convert_history(self, pending):
+    """
+    Converts a chunk of (document, notebook data) history entries with bulk inserts. The Document2 rows, their doc1
+        links, the default tags of the links and the imported tags of the source documents are each written with a
+        single statement. If the chunk fails it is converted again one document at a time.
+    """
+    if not pending:
+      return
+
+    try:
+      with transaction.atomic():
+        history_docs = [self._build_history_doc(data, doc) for doc, data in pending]
+        with _keep_last_modified(Document2):
+          Document2.objects.bulk_create(history_docs)
+
+        # bulk_create does not return ids on every backend
+        doc2_ids = dict(Document2.objects.filter(uuid__in=[history_doc.uuid for history_doc in history_docs]).values_list('uuid', 'id'))
+        for history_doc in history_docs:
+          history_doc.id = doc2_ids[history_doc.uuid]
+
+        # Create doc1 copies and link them for backwards compatibility
+        doc2_content_type = ContentType.objects.get_for_model(Document2)
+        Document.objects.bulk_create([
+          Document(
+            content_type=doc2_content_type,
+            object_id=history_doc.id,
+            owner=self.user,
+            name=history_doc.name,
+            description=history_doc.description,
+            # Same as the link _historify creates
+            extra=history_doc.type
+          )
+          for history_doc in history_docs
+        ])
+        link_ids = Document.objects.filter(content_type=doc2_content_type, object_id__in=doc2_ids.values()).values_list('id', flat=True)
+
+        # Tag links with the default tag and the source docs with the imported tag for not re-importing
+        DocumentTags = Document.tags.through
+        default_tag = DocumentTag.objects.get_default_tag(user=self.user)
+        source_ids = [doc.id for doc, data in pending]
+        already_tagged = set(DocumentTags.objects.filter(document_id__in=source_ids, documenttag_id=self.imported_tag.id).values_list('document_id', flat=True))
+        tags = [DocumentTags(document_id=link_id, documenttag_id=default_tag.id) for link_id in link_ids]
+        tags += [DocumentTags(document_id=source_id, documenttag_id=self.imported_tag.id) for source_id in source_ids if source_id not in already_tagged]
+        DocumentTags.objects.bulk_create(tags)
+    except TRANSIENT_DB_ERRORS:
+      raise
+    except Exception, e:
+      LOG.warn("Bulk history conversion of %s docs failed, converting one by one: %s" % (len(pending), e))
+      for doc, data in pending:
+        self._convert_history_doc(doc, data)
+      return
+
+    self.imported_count += len(history_docs)
+    for doc, data in pending:
+      self._record('query_history', doc, CONVERTED)
+
+
   def _get_statement(self, notebook):
     statement = ''
     if notebook['snippets'] and len(notebook['snippets']) > 0:
@@ -0,0 +1,55 @@
+import logging
+from django.db import transaction
+from desktop.models import Directory, Document, Document2
+from orphan_scan import orphaned
+
+LOG = logging.getLogger(__name__)
+
+
+class OrphanedDocumentRecovery(object):
+  """
+  Moves the Document2 objects whose owner no longer exists to new_owner, under one recover-<old owner id> directory
+  per missing owner in new_home_dir. Docs of an owner and their doc1 links are reassigned with one UPDATE each and
+  Document.objects.sync() runs once at the end instead of once per doc. Orphaned directories are deleted.
+  """
+
+  def __init__(self, new_owner, new_home_dir):
+    self.new_owner = new_owner
+    self.new_home_dir = new_home_dir
+    self.recovered = 0
+    self.deleted_directories = 0
+
+
+  def orphans(self):
+    return orphaned(Document2, 'owner')
+
+
+  def _recover_owner(self, owner_id):
+    # The owner is gone, every doc still pointing to it is an orphan
+    docs = Document2.objects.filter(owner_id=owner_id).exclude(type='directory')
+    with transaction.atomic():
+      recover_dir = Directory.objects.create(name="recover-%s" % owner_id, owner=self.new_owner, parent_directory=self.new_home_dir)
+      # The doc1 links are selected with a subquery on the owner of the docs, so they have to move first. A list of
+      # ids could exceed the bind variable limit of the backend (999 on sqlite) for owners with many docs.
+      Document.objects.filter(id__in=docs.exclude(doc__isnull=True).values('doc')).update(owner=self.new_owner)
+      moved = docs.update(owner=self.new_owner, parent_directory=recover_dir)
+    LOG.info("Migrated %s orphaned docs of owner id %s to %s" % (moved, owner_id, recover_dir.name))
+    return moved
+
+
+  def recover(self):
+    owner_ids = list(self.orphans().exclude(type='directory').values_list('owner_id', flat=True).distinct())
+    LOG.info("Found orphaned docs of %s missing owners" % len(owner_ids))
+    for owner_id in owner_ids:
+      self.recovered += self._recover_owner(owner_id)
+
+    directories = self.orphans().filter(type='directory')
+    self.deleted_directories = directories.count()
+    if self.deleted_directories:
+      LOG.info("Deleting %s orphaned directories" % self.deleted_directories)
+      directories.delete()
+
+    if self.recovered:
+      Document.objects.sync()
+    LOG.info("Migrated %s orphaned docs to orphaned doc owner: %s" % (self.recovered, self.new_owner.username))
+    return self.recovered
@@ -0,0 +1,58 @@
+import logging
+from django.db import connection
+from desktop.models import Document, Document2, DocumentPermission, UserPreferences
+from purge_engine import BatchPurger
+
+LOG = logging.getLogger(__name__)
+
+# (model, foreign key) pairs the cleanup commands check for rows pointing to a missing object
+ORPHAN_CHECKS = (
+  (Document, 'owner'),
+  (Document2, 'owner'),
+  (DocumentPermission, 'doc'),
+  (UserPreferences, 'user'),
+)
+
+# Orphaned rows that are only left behind by deleted docs and users and can be deleted outright
+PURGEABLE_ORPHANS = (
+  (DocumentPermission, 'doc'),
+  (UserPreferences, 'user'),
+)
+
+
+def orphaned(model, field):
+  """
+  Returns a queryset of the rows of model whose field points to a row that does not exist. Uses a correlated
+  NOT EXISTS anti-join rather than exclude(field__in=all ids), which some backends turn into a huge NOT IN list.
+  """
+  qn = connection.ops.quote_name
+  fk = model._meta.get_field(field)
+  try:
+    target = fk.rel.to
+  except AttributeError:
+    target = fk.remote_field.model
+  where = "NOT EXISTS (SELECT 1 FROM %s WHERE %s.%s = %s.%s)" % (
+    qn(target._meta.db_table),
+    qn(target._meta.db_table), qn(target._meta.pk.column),
+    qn(model._meta.db_table), qn(fk.column))
+  return model.objects.extra(where=[where])
+
+
+def purge_orphans(make_purger=BatchPurger, **options):
+  """
+  Deletes the PURGEABLE_ORPHANS rows in batches, make_purger(queryset, **options) builds the purger of each model
+  """
+  for model, field in PURGEABLE_ORPHANS:
+    LOG.info("Looping through orphaned %s objects." % model.__name__)
+    make_purger(orphaned(model, field), **options).purge()
+
+
+def count_orphans():
+  """
+  Returns {model name: number of orphaned rows} for every ORPHAN_CHECKS pair
+  """
+  counts = {}
+  for model, field in ORPHAN_CHECKS:
+    counts[model.__name__] = orphaned(model, field).count()
+    LOG.info("Found %s orphaned %s objects" % (counts[model.__name__], model.__name__))
+  return counts
@@ -0,0 +1,56 @@
+import os
+import gzip
+import json
+import time
+import logging
+import threading
+
+LOG = logging.getLogger(__name__)
+
+
+class PurgeArchiver(object):
+  """
+  Writes the rows of each delete batch to gzipped newline delimited JSON files before they are deleted, one set of
+  files per model rolled over every rows_per_file rows. Rows are read with values() and written one line at a time,
+  so memory stays at one batch. Each batch is sync flushed, the files can be read up to the last batch even if the
+  purge is killed. A batch that fails to delete is retried and archived again, so a row may appear more than once.
+  """
+
+  def __init__(self, directory, rows_per_file=1000000):
+    self.directory = directory
+    self.rows_per_file = rows_per_file
+    self.stamp = time.strftime("%Y%m%d%H%M%S")
+    self.lock = threading.Lock()
+    self.files = {}
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+
+  def _open(self, name, part):
+    path = os.path.join(self.directory, "%s-%s-%04d.ndjson.gz" % (name, self.stamp, part))
+    LOG.info("Archiving %s objects to: %s" % (name, path))
+    return {'handle': gzip.open(path, "wb"), 'part': part, 'rows': 0}
+
+
+  def write(self, model, ids):
+    name = model.__name__
+    rows = list(model.objects.filter(pk__in=ids).order_by('pk').values())
+    # Parallel purges can work on id ranges of the same model
+    with self.lock:
+      archive = self.files.get(name)
+      if archive is None:
+        archive = self.files[name] = self._open(name, 1)
+      for row in rows:
+        if archive['rows'] >= self.rows_per_file:
+          archive['handle'].close()
+          archive = self.files[name] = self._open(name, archive['part'] + 1)
+        archive['handle'].write(json.dumps(row, default=str, separators=(',', ':')) + "\n")
+        archive['rows'] += 1
+      archive['handle'].flush()
+
+
+  def close(self):
+    with self.lock:
+      for archive in self.files.values():
+        archive['handle'].close()
+      self.files = {}
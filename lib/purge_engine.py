@@ -0,0 +1,243 @@
+import os
+import json
+import time
+import logging
+import threading
+import Queue
+from django.db import connection
+from django.db.models import Min, Max
+from django.db.utils import DatabaseError
+
+LOG = logging.getLogger(__name__)
+
+
+class BatchPurger(object):
+  """
+  Deletes the rows of a queryset in primary key order, one batch of ids at a time. Batches are read with
+  pk > last deleted pk so the filter is never counted or rescanned from the start, and the batch size grows while
+  deletes stay under target_latency seconds and shrinks when they are slower or fail.
+  """
+
+  def __init__(self, queryset, batch_size=999, min_batch_size=1, max_batch_size=999, target_latency=1.0, max_errors=10, rate_limiter=None, throttle=None, archiver=None):
+    self.queryset = queryset
+    self.model = queryset.model
+    self.batch_size = batch_size
+    self.min_batch_size = min_batch_size
+    # Most backends limit the number of SQL variables, 999 on sqlite
+    self.max_batch_size = max_batch_size
+    self.target_latency = target_latency
+    self.max_errors = max_errors
+    self.rate_limiter = rate_limiter
+    self.throttle = throttle
+    self.archiver = archiver
+    self.deleted = 0
+    self.elapsed = 0.0
+    self.last_id = None
+
+
+  def _next_ids(self):
+    queryset = self.queryset
+    if self.last_id is not None:
+      queryset = queryset.filter(pk__gt=self.last_id)
+    return list(queryset.order_by('pk').values_list('pk', flat=True)[:self.batch_size])
+
+
+  def _delete(self, ids):
+    self.model.objects.filter(pk__in=ids).delete()
+
+
+  def _adapt(self, latency):
+    if latency > self.target_latency:
+      self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+    elif latency < self.target_latency / 2:
+      self.batch_size = min(int(self.batch_size * 1.5) + 1, self.max_batch_size)
+
+
+  def delete_batch(self):
+    """
+    Deletes the next batch, returns the number of rows deleted or None once there is nothing left
+    """
+    ids = self._next_ids()
+    if not ids:
+      return None
+    if self.rate_limiter is not None:
+      self.rate_limiter.acquire(len(ids))
+    if self.archiver is not None:
+      self.archiver.write(self.model, ids)
+    start = time.time()
+    self._delete(ids)
+    latency = time.time() - start
+    self.elapsed += latency
+    self.deleted += len(ids)
+    self.last_id = ids[-1]
+    self._adapt(latency)
+    if self.throttle is not None:
+      self.throttle.check(self, latency)
+    return len(ids)
+
+
+  def purge(self):
+    name = self.model.__name__
+    start = time.time()
+    errors = 0
+    LOG.info("Deleting %s objects in batches of up to %s" % (name, self.max_batch_size))
+    while True:
+      try:
+        deleted = self.delete_batch()
+        errors = 0
+      except DatabaseError, e:
+        LOG.info("Non Fatal Exception: %s: %s" % (e.__class__.__name__, e))
+        errors += 1
+        if errors >= self.max_errors and self.batch_size == self.min_batch_size:
+          raise
+        self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+        LOG.info("Decreasing max delete records to: %s" % self.batch_size)
+        continue
+      if deleted is None:
+        break
+      LOG.debug("%s objects deleted: %s batch size: %s" % (name, self.deleted, self.batch_size))
+
+    elapsed = time.time() - start
+    rate = self.deleted / elapsed if elapsed else 0
+    LOG.info("Deleted %s %s objects in %.2f seconds: %.1f rows/sec" % (self.deleted, name, elapsed, rate))
+    return self.deleted
+
+
+class LatencyThrottle(object):
+  """
+  Pauses purges and shrinks their batches while the delete statements take longer than latency_budget seconds or,
+  when a Hue metrics sample file is given, while desktop.requests.aggregate-response-time is above
+  response_time_budget seconds. A budget of 0 disables that check.
+  """
+
+  RESPONSE_TIME_METRIC = 'desktop.requests.aggregate-response-time'
+
+  def __init__(self, latency_budget=0, metrics_file=None, response_time_budget=0, response_time_stat='95_percentile',
+               pause=5, max_pause=300, metrics_max_age=300):
+    self.latency_budget = latency_budget
+    self.metrics_file = metrics_file
+    self.response_time_budget = response_time_budget
+    self.response_time_stat = response_time_stat
+    self.pause = pause
+    self.max_pause = max_pause
+    # Hue stops refreshing the sample file when it is down, ignore stale samples
+    self.metrics_max_age = metrics_max_age
+
+
+  def response_time(self):
+    """
+    Returns Hue's request response time from the metrics sample file, None if it cannot be read or is stale
+    """
+    if not self.metrics_file or not self.response_time_budget:
+      return None
+    try:
+      if time.time() - os.path.getmtime(self.metrics_file) > self.metrics_max_age:
+        return None
+      with open(self.metrics_file) as sample:
+        metrics = json.load(sample)
+      return metrics[self.RESPONSE_TIME_METRIC][self.response_time_stat]
+    except (IOError, OSError, ValueError, KeyError, TypeError), e:
+      LOG.debug("Cannot read %s from %s: %s" % (self.RESPONSE_TIME_METRIC, self.metrics_file, e))
+      return None
+
+
+  def _over_budget(self, latency):
+    if self.latency_budget and latency is not None and latency > self.latency_budget:
+      return "delete latency %.2fs over budget %.2fs" % (latency, self.latency_budget)
+    response_time = self.response_time()
+    if response_time is not None and response_time > self.response_time_budget:
+      return "Hue response time %.2fs over budget %.2fs" % (response_time, self.response_time_budget)
+    return None
+
+
+  def check(self, purger, latency):
+    reason = self._over_budget(latency)
+    pause = self.pause
+    waited = 0
+    while reason is not None and waited < self.max_pause:
+      purger.batch_size = max(purger.batch_size // 2, purger.min_batch_size)
+      LOG.info("Throttling %s purge: %s, pausing %s seconds with batch size %s" % (purger.model.__name__, reason, pause, purger.batch_size))
+      time.sleep(pause)
+      waited += pause
+      pause = min(pause * 2, self.max_pause)
+      # The last delete latency is stale after pausing, only Hue's response time can be checked again
+      reason = self._over_budget(None)
+
+
+class RateLimiter(object):
+  """
+  Paces the rows deleted per second across all purge threads sharing it
+  """
+
+  def __init__(self, rows_per_second):
+    self.rows_per_second = float(rows_per_second)
+    self.lock = threading.Lock()
+    self.next_time = time.time()
+
+
+  def acquire(self, rows):
+    with self.lock:
+      now = time.time()
+      start = max(now, self.next_time)
+      self.next_time = start + rows / self.rows_per_second
+    if start > now:
+      time.sleep(start - now)
+
+
+def split_by_pk(queryset, partitions):
+  """
+  Splits a queryset into partitions querysets over equal primary key ranges
+  """
+  if partitions <= 1:
+    return [queryset]
+  bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+  if bounds['low'] is None:
+    return []
+  low, high = bounds['low'], bounds['high'] + 1
+  step = max((high - low) // partitions, 1)
+  querysets = []
+  for start in range(low, high, step):
+    querysets.append(queryset.filter(pk__gte=start, pk__lt=min(start + step, high)))
+  return querysets
+
+
+def parallel_purge(querysets, workers, make_purger=BatchPurger, **purger_options):
+  """
+  Purges the querysets with up to workers threads, each thread uses its own DB connection.
+  Purgers are created with make_purger(queryset, **purger_options), pass a shared RateLimiter as rate_limiter to cap
+  the total delete rate. Returns the number of rows deleted.
+  """
+  tasks = Queue.Queue()
+  for queryset in querysets:
+    tasks.put(queryset)
+
+  lock = threading.Lock()
+  results = {'deleted': 0, 'errors': []}
+
+  def run():
+    try:
+      while True:
+        try:
+          queryset = tasks.get_nowait()
+        except Queue.Empty:
+          return
+        try:
+          deleted = make_purger(queryset, **purger_options).purge()
+          with lock:
+            results['deleted'] += deleted
+        except Exception, e:
+          LOG.exception("Purge of %s objects failed" % queryset.model.__name__)
+          with lock:
+            results['errors'].append(e)
+    finally:
+      connection.close()
+
+  threads = [threading.Thread(target=run, name="purge-%s" % i) for i in range(min(workers, len(querysets)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if results['errors']:
+    raise results['errors'][0]
+  return results['deleted']
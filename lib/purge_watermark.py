@@ -0,0 +1,38 @@
+import os
+import json
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class PurgeWatermarks(object):
+  """
+  JSON file of the lowest primary key that may still need purging per cleanup, with the cutoff it was computed for.
+  Every row matching a cleanup filter below that key was deleted by an earlier run, so the next run only scans
+  pk >= watermark instead of the whole date range.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.marks = {}
+    if os.path.exists(path):
+      with open(path) as marks:
+        self.marks = json.load(marks)
+      LOG.info("Loaded purge watermarks from: %s" % path)
+
+
+  def get(self, key):
+    mark = self.marks.get(key)
+    return mark['pk'] if mark else None
+
+
+  def set(self, key, pk, cutoff):
+    self.marks[key] = {'pk': pk, 'cutoff': str(cutoff)}
+
+
+  def save(self):
+    # Write and rename so a killed run never leaves a truncated file behind
+    tmp = self.path + ".tmp"
+    with open(tmp, "w") as marks:
+      json.dump(self.marks, marks, indent=2, sort_keys=True)
+    os.rename(tmp, self.path)